@@ -1,6 +1,7 @@
 #include "client.h"
 #include "file_handler.h"
 #include "protocol.h"
+#include <algorithm>
 #include <stdexcept>
 #include <iostream>
 
@@ -100,7 +101,9 @@ void Client::exchange_keys() {
 /**
  * @brief Sends a file to the server.
  *
- * Reads, encrypts, and sends the file in chunks to the server.
+ * Reads, encrypts, and sends the file in chunks to the server. Up to WINDOW_SIZE
+ * chunks are in flight at a time and the server acknowledges them cumulatively.
+ * Chunks the server kept from an interrupted transfer of the same file are skipped.
  * Also calculates and sends CRC for verification.
  */
 void Client::send_file(const std::string& file_path) {
@@ -118,30 +121,70 @@ void Client::send_file(const std::string& file_path) {
     std::vector<uint8_t> file_name_bytes(file_name.begin(), file_name.end());
     file_name_bytes.resize(255, 0);  // Pad with zeros to 255 bytes
 
-    size_t offset = 0;
-    for (uint16_t packet_number = 1; packet_number <= total_packets; ++packet_number) {
-        size_t chunk_size = std::min<size_t>(MAX_PACKET_SIZE, content_size - offset);
-        if (offset + chunk_size > encrypted_content.size()) {
-            throw std::runtime_error("Chunk size exceeds file size");
+    // Ask which chunks the server already has from an interrupted transfer of this file
+    std::vector<bool> received(total_packets, false);
+    send_request(829, file_name_bytes);
+    auto status = m_network.receive_response();
+    if (*reinterpret_cast<const uint16_t*>(&status[1]) == 1609 && status.size() >= 7 + 16 + 255 + 2) {
+        uint16_t status_packets = *reinterpret_cast<const uint16_t*>(&status[7 + 16 + 255]);
+        size_t bitmap_offset = 7 + 16 + 255 + 2;
+        if (status_packets == total_packets && status.size() >= bitmap_offset + (total_packets + 7) / 8) {
+            for (uint16_t i = 0; i < total_packets; ++i) {
+                received[i] = (status[bitmap_offset + i / 8] >> (i % 8)) & 1;
+            }
         }
+    }
 
-        // Prepare payload for file chunk
-        std::vector<uint8_t> payload;
-        payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&content_size), reinterpret_cast<uint8_t*>(&content_size) + sizeof(content_size));
-        payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&orig_file_size), reinterpret_cast<uint8_t*>(&orig_file_size) + sizeof(orig_file_size));
-        payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&packet_number), reinterpret_cast<uint8_t*>(&packet_number) + sizeof(packet_number));
-        payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&total_packets), reinterpret_cast<uint8_t*>(&total_packets) + sizeof(total_packets));
-        payload.insert(payload.end(), file_name_bytes.begin(), file_name_bytes.end());
-        payload.insert(payload.end(), encrypted_content.begin() + offset, encrypted_content.begin() + offset + chunk_size);
+    // Keep up to WINDOW_SIZE chunks in flight; the server acks them cumulatively
+    uint16_t acked_packets = 0;
+    while (acked_packets < total_packets && received[acked_packets]) {
+        ++acked_packets;
+    }
+    if (acked_packets > 0) {
+        std::cout << "Resuming transfer after " << acked_packets << " of " << total_packets << " chunks" << std::endl;
+    }
+    uint16_t next_packet = acked_packets + 1;
+    bool file_accepted = false;
+    while (!file_accepted) {
+        while (next_packet <= total_packets && next_packet - acked_packets <= WINDOW_SIZE) {
+            size_t offset = static_cast<size_t>(next_packet - 1) * MAX_PACKET_SIZE;
+            size_t chunk_size = std::min<size_t>(MAX_PACKET_SIZE, content_size - offset);
+            if (offset + chunk_size > encrypted_content.size()) {
+                throw std::runtime_error("Chunk size exceeds file size");
+            }
 
-        send_request(828, payload);
-        std::cout << "Sent chunk " << packet_number << " of " << total_packets << std::endl;
+            // Prepare payload for file chunk
+            std::vector<uint8_t> payload;
+            payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&content_size), reinterpret_cast<uint8_t*>(&content_size) + sizeof(content_size));
+            payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&orig_file_size), reinterpret_cast<uint8_t*>(&orig_file_size) + sizeof(orig_file_size));
+            payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&next_packet), reinterpret_cast<uint8_t*>(&next_packet) + sizeof(next_packet));
+            payload.insert(payload.end(), reinterpret_cast<uint8_t*>(&total_packets), reinterpret_cast<uint8_t*>(&total_packets) + sizeof(total_packets));
+            payload.insert(payload.end(), file_name_bytes.begin(), file_name_bytes.end());
+            payload.insert(payload.end(), encrypted_content.begin() + offset, encrypted_content.begin() + offset + chunk_size);
 
-        // Wait for server acknowledgment after each chunk
-        auto response = m_network.receive_data();
-        handle_server_response(response);
+            send_request(828, payload, WINDOWED_VERSION);
+            std::cout << "Sent chunk " << next_packet << " of " << total_packets << std::endl;
+            do {
+                ++next_packet;
+            } while (next_packet <= total_packets && received[next_packet - 1]);
+        }
 
-        offset += chunk_size;
+        // Wait for the next ack, or for the file acceptance after the last chunk
+        auto response = m_network.receive_response();
+        uint16_t code = *reinterpret_cast<const uint16_t*>(&response[1]);
+        if (code == 1608) {
+            if (response.size() < 7 + 16 + 255 + 2) {
+                throw std::runtime_error("Invalid chunk acknowledgement");
+            }
+            uint16_t packet_number = *reinterpret_cast<const uint16_t*>(&response[7 + 16 + 255]);
+            acked_packets = std::max(acked_packets, packet_number);
+            continue;
+        }
+        if (code == 1604) {
+            ++acked_packets;  // A server without windowed transfers acks every chunk
+        }
+        handle_server_response(response);
+        file_accepted = (code == 1603);
     }
 
     // Send final CRC confirmation
@@ -150,7 +193,7 @@ void Client::send_file(const std::string& file_path) {
     send_request(900, crc_payload);
 
     // Wait for final server confirmation
-    auto final_response = m_network.receive_data();
+    auto final_response = m_network.receive_response();
     handle_server_response(final_response);
 }
 
@@ -200,6 +243,9 @@ void Client::handle_server_response(const std::vector<uint8_t>& response) {
         throw std::runtime_error("Reconnection denied");
     case 1607:  // General error
         throw std::runtime_error("Server responded with an error");
+    case 1608:  // File chunks acknowledged
+        std::cout << "Server acknowledged file chunks." << std::endl;
+        break;
     default:
         throw std::runtime_error("Unknown response code from server");
     }
@@ -210,7 +256,7 @@ void Client::handle_server_response(const std::vector<uint8_t>& response) {
  *
  * Creates and sends a request with the specified code and payload.
  */
-void Client::send_request(uint16_t code, const std::vector<uint8_t>& payload) {
-    std::vector<uint8_t> request = Protocol::create_request(m_client_id, 3, code, payload);
+void Client::send_request(uint16_t code, const std::vector<uint8_t>& payload, uint8_t version) {
+    std::vector<uint8_t> request = Protocol::create_request(m_client_id, version, code, payload);
     m_network.send_data(request);
 }
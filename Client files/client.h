@@ -5,6 +5,9 @@
 #include "crypto.h"
 #include "network.h"
 #define MAX_PACKET_SIZE 1024
+#define PROTOCOL_VERSION 3
+#define WINDOWED_VERSION 4  // File chunks are sent in a window and acked cumulatively
+#define WINDOW_SIZE 32      // Chunks in flight, must be at least the server's ack interval (8)
 
 class Client {
 public:
@@ -27,5 +30,5 @@ private:
     NetworkClient m_network;
 
     void handle_server_response(const std::vector<uint8_t>& response);
-    void send_request(uint16_t code, const std::vector<uint8_t>& payload);
+    void send_request(uint16_t code, const std::vector<uint8_t>& payload, uint8_t version = PROTOCOL_VERSION);
 };
@@ -37,4 +37,22 @@ std::vector<uint8_t> NetworkClient::receive_data()
     size_t length = m_socket.read_some(boost::asio::buffer(received_data));
     received_data.resize(length);
     return received_data;
+}
+
+/**
+ * @brief Receives exactly one response (header and payload) from the connection.
+ *
+ * Unlike receive_data(), this never returns part of a response or more than one,
+ * so it can be used while several requests are in flight.
+ *
+ * @return std::vector<uint8_t> The response header followed by its payload.
+ */
+std::vector<uint8_t> NetworkClient::receive_response()
+{
+    std::vector<uint8_t> response(7);  // Version (1), code (2), payload size (4)
+    boost::asio::read(m_socket, boost::asio::buffer(response));
+    uint32_t payload_size = response[3] | (response[4] << 8) | (response[5] << 16) | (static_cast<uint32_t>(response[6]) << 24);
+    response.resize(7 + payload_size);
+    boost::asio::read(m_socket, boost::asio::buffer(response.data() + 7, payload_size));
+    return response;
 }
\ No newline at end of file
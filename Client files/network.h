@@ -12,6 +12,7 @@ public:
 
     void send_data(const std::vector<uint8_t>& data);
     std::vector<uint8_t> receive_data();
+    std::vector<uint8_t> receive_response();
 
 private:
     boost::asio::io_context m_io_context;
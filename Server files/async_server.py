@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from dataBase import setup_database, close_database
+from file_handler import suspend_uploads, discard_stale_uploads, collect_blobs
+from framing import MAX_PAYLOAD_SIZE
+from handlers import process_request
+from output_queue import HIGH_WATERMARK, LOW_WATERMARK
+from crypto_worker import Deferred
+from download import FileStream
+from capture import get_capture
+from scheduler import charge
+from metrics import (BYTES_RECEIVED, BYTES_SENT, SEND_SECONDS, ACTIVE_CONNECTIONS, LOOP_LAG_SECONDS,
+                     LOOP_LAG_INTERVAL)
+from protocol import REQUEST_HEADER_SIZE, parse_request_header
+
+
+async def handle_connection(reader, writer, executor):
+    """
+    Serve a single client connection. Requests are read frame by frame and handed
+    to the shared request handlers on the executor, so database, crypto and disk
+    work never blocks the event loop. Responses are written in request order.
+    """
+    addr = writer.get_extra_info('peername')
+    logging.info("Accepted connection from %s", addr)
+    ACTIVE_CONNECTIONS.inc()
+    data = types.SimpleNamespace(addr=addr, file_data={})
+    trace = get_capture()
+    trace_connection = trace.open_connection(addr) if trace is not None else None
+    # Use the same output watermarks as the selectors engine for drain()
+    writer.transport.set_write_buffer_limits(high=HIGH_WATERMARK, low=LOW_WATERMARK)
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(REQUEST_HEADER_SIZE)
+            except asyncio.IncompleteReadError as e:
+                if e.partial:
+                    logging.warning("Client %s disconnected in the middle of a request header", addr)
+                else:
+                    logging.info("Client %s closed the connection", addr)
+                break
+            client_id, version, code, payload_size = parse_request_header(header)
+            if payload_size > MAX_PAYLOAD_SIZE:
+                raise ValueError(f"Payload size {payload_size} exceeds limit of {MAX_PAYLOAD_SIZE} bytes")
+            payload = await reader.readexactly(payload_size)
+            BYTES_RECEIVED.inc(REQUEST_HEADER_SIZE + payload_size)
+            if trace_connection is not None:
+                trace.request(trace_connection, client_id, version, code, payload)
+            response = await loop.run_in_executor(executor, process_request,
+                                                  data, client_id, version, code, payload)
+            if isinstance(response, Deferred):
+                # Wait for the crypto stage without holding an executor thread
+                await asyncio.wrap_future(response.future)
+                response = await loop.run_in_executor(executor, response.resolve)
+            if isinstance(response, FileStream):
+                await send_stream(writer, response, executor)
+            else:
+                await send_response(writer, [response])
+            delay = charge(client_id, REQUEST_HEADER_SIZE + payload_size)
+            if delay:
+                # The client used up its bandwidth, stop reading from it for a while
+                await asyncio.sleep(delay)
+    except Exception as e:
+        logging.error("Error handling client %s: %s", addr, e)
+    finally:
+        ACTIVE_CONNECTIONS.dec()
+        if trace_connection is not None:
+            trace.close_connection(trace_connection)
+        suspend_uploads(data.file_data)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def send_response(writer, buffers):
+    """
+    Write the buffers of one response and wait until the transport can take more.
+    """
+    start = time.perf_counter()
+    writer.writelines(buffers)
+    # Waits only when the client is slow to read, other connections keep running
+    await writer.drain()
+    SEND_SECONDS.time_since(start)
+    BYTES_SENT.inc(sum(len(buffer) for buffer in buffers))
+
+
+async def send_stream(writer, stream, executor):
+    """
+    Send a download chunk by chunk. The next chunk is sealed on the executor only
+    after drain() let the previous one through, so a slow client holds back the
+    download instead of filling memory.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while not stream.done:
+            await send_response(writer, await loop.run_in_executor(executor, stream.next_chunk))
+    finally:
+        stream.close()
+
+
+async def monitor_loop_lag():
+    """
+    Measure how late a periodic sleep wakes up. The delay is the time ready
+    callbacks had to wait for the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+
+async def serve(host, port, max_workers=None, server_socket=None):
+    """
+    Start listening on host:port, or on an already bound server_socket, and serve
+    clients until cancelled.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='server-worker')
+    client_connected = lambda reader, writer: handle_connection(reader, writer, executor)
+    if server_socket is not None:
+        server = await asyncio.start_server(client_connected, sock=server_socket)
+    else:
+        server = await asyncio.start_server(client_connected, host, port)
+        logging.info("Server listening on %s:%s (asyncio engine)", host, port)
+    lag_monitor = asyncio.create_task(monitor_loop_lag())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        lag_monitor.cancel()
+        executor.shutdown(wait=False)
+        close_database()
+
+
+def install_uvloop():
+    """
+    Switch asyncio to uvloop if it is installed. Returns True when uvloop is active.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        logging.warning("uvloop is not installed. Using the default asyncio event loop.")
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def start_async_server(host, port, use_uvloop=False, max_workers=None, server_socket=None):
+    """
+    Start the asyncio based server. This is an alternative to the selectors loop in
+    mainServer.start_server and uses the same request handlers.
+    """
+    setup_database()
+    discard_stale_uploads()
+    collect_blobs()
+    if use_uvloop:
+        install_uvloop()
+    asyncio.run(serve(host, port, max_workers, server_socket))
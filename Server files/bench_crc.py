@@ -0,0 +1,53 @@
+import argparse
+import os
+import time
+import zlib
+import crc
+
+
+def measure(fn, data, min_time):
+    """
+    Runs fn(data) repeatedly for at least min_time seconds and returns the best
+    throughput in MB/s.
+    """
+    best = None
+    deadline = time.perf_counter() + min_time
+    while True:
+        start = time.perf_counter()
+        fn(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        if time.perf_counter() >= deadline:
+            break
+    return len(data) / best / 1e6 if best else float('inf')
+
+
+def main():
+    """
+    Compare the cksum engines of crc.py with zlib.crc32 over a few buffer sizes,
+    after checking that all cksum engines agree.
+    """
+    parser = argparse.ArgumentParser(description="CRC micro-benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024],
+                        help="buffer sizes in bytes")
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds to spend per measurement")
+    args = parser.parse_args()
+
+    engines = [('zlib.crc32', zlib.crc32), ('cksum bytewise', crc._cksum_bytewise),
+               ('cksum slice-by-8', crc._cksum_slice8), ('cksum via zlib', crc._cksum_zlib)]
+
+    for size in args.sizes:
+        data = os.urandom(size)
+        expected = crc._cksum_bytewise(data)
+        for name, fn in engines:
+            if name.startswith('cksum') and fn(data) != expected:
+                raise SystemExit(f"{name} disagrees with the bytewise engine for {size} bytes")
+        print(f"{size} bytes:")
+        for name, fn in engines:
+            if name == 'cksum bytewise' and size > 1024 * 1024:
+                continue  # Too slow to be worth measuring
+            print(f"  {name:<18} {measure(fn, data, args.min_time):10.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
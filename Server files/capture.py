@@ -0,0 +1,207 @@
+import atexit
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from dataBase import add_client_listener, get_client, get_all_clients
+from protocol import REQUEST_HEADER
+
+# A trace starts with TRACE_HEADER: the magic bytes and the wall clock time the
+# capture started. Records follow, each a RECORD_HEADER (kind, connection number,
+# seconds since the start, body size) and its body.
+TRACE_MAGIC = b'SFTRACE1'
+TRACE_HEADER = struct.Struct('<8sd')
+RECORD_HEADER = struct.Struct('<BIdI')
+# Record kinds. OPEN carries the peer address as text and REQUEST the request as
+# received, header and payload. CLIENT records hold a client's row (connection 0),
+# written for every client when the capture starts and whenever a row changes.
+OPEN, REQUEST, CLOSE, CLIENT = 1, 2, 3, 4
+CLIENT_RECORD = struct.Struct('<16sHHH')  # Client ID and the sizes of name, public key and AES key
+CAPTURE_QUEUE_SIZE = 100000  # Records waiting for the writer thread before new ones are dropped
+CAPTURE_BUFFER_SIZE = 1024 * 1024  # Bytes buffered before the trace file is written to
+
+
+def encode_client(client_id, name, public_key, aes_key):
+    """
+    Encodes a client's row as the body of a CLIENT record.
+    """
+    name = name.encode('utf-8')
+    public_key = public_key or b''
+    return CLIENT_RECORD.pack(client_id, len(name), len(public_key), len(aes_key)) + name + public_key + aes_key
+
+
+def decode_client(body):
+    """
+    Decodes the body of a CLIENT record into (client_id, name, public_key, aes_key).
+    """
+    client_id, name_size, key_size, aes_key_size = CLIENT_RECORD.unpack_from(body)
+    offset = CLIENT_RECORD.size
+    name = body[offset:offset + name_size].decode('utf-8')
+    offset += name_size
+    public_key = body[offset:offset + key_size]
+    offset += key_size
+    return client_id, name, public_key or None, body[offset:offset + aes_key_size]
+
+
+def read_trace(path):
+    """
+    Yields the records of a trace file as (kind, connection, seconds, body) tuples.
+    Raises ValueError if the file is not a trace. A record cut off by a crash ends
+    the trace.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(TRACE_HEADER.size)
+        if len(header) < TRACE_HEADER.size or TRACE_HEADER.unpack(header)[0] != TRACE_MAGIC:
+            raise ValueError(f"{path} is not a traffic trace")
+        while True:
+            record = f.read(RECORD_HEADER.size)
+            if len(record) < RECORD_HEADER.size:
+                return
+            kind, connection, seconds, size = RECORD_HEADER.unpack(record)
+            body = f.read(size)
+            if len(body) < size:
+                return
+            yield kind, connection, seconds, body
+
+
+class TraceWriter:
+    """
+    Records the requests of every connection with their arrival time to a trace file.
+    Records are handed to a writer thread through a bounded queue, so capturing never
+    blocks the event loop on the disk; when the queue is full, records are dropped
+    and counted. The trace holds client keys and encrypted file content, and must be
+    protected like the database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dropped = 0
+        self._start = time.monotonic()
+        self._connections = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(CAPTURE_QUEUE_SIZE)
+        # Created readable by the owner only, the trace holds client keys; an existing
+        # file is emptied before its mode is tightened
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o600)
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o600)
+        self._file = os.fdopen(fd, 'wb', buffering=CAPTURE_BUFFER_SIZE)
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, time.time()))
+        self._thread = threading.Thread(target=self._write_records, name='capture-writer', daemon=True)
+        self._thread.start()
+
+    def open_connection(self, addr):
+        """
+        Records a new connection and returns its number for the later records.
+        """
+        with self._lock:
+            self._connections += 1
+            connection = self._connections
+        self._record(OPEN, connection, str(addr).encode('utf-8'))
+        return connection
+
+    def request(self, connection, client_id, version, code, payload):
+        """
+        Records a request of a connection. The payload is copied, so it may be a view
+        into a receive buffer that is reused afterwards.
+        """
+        self._record(REQUEST, connection, REQUEST_HEADER.pack(client_id, version, code, len(payload)) + payload)
+
+    def close_connection(self, connection):
+        """
+        Records that a connection was closed.
+        """
+        self._record(CLOSE, connection, b'')
+
+    def client_changed(self, client_id):
+        """
+        Records the current row of a client, so a replay starts from the same keys.
+        """
+        row = get_client(client_id)
+        if row is not None:
+            self.record_client(row)
+
+    def record_client(self, row):
+        """
+        Records a row of the clients table.
+        """
+        self._record(CLIENT, 0, encode_client(row[0], row[1], row[2], row[4]))
+
+    def _record(self, kind, connection, body):
+        record = RECORD_HEADER.pack(kind, connection, time.monotonic() - self._start, len(body)) + body
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_records(self):
+        """
+        Body of the writer thread. The file is flushed whenever the queue runs empty,
+        so a burst of records costs a single write.
+        """
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self._file.write(record)
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def close(self):
+        """
+        Writes out the queued records and closes the trace.
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self.dropped:
+            logging.warning("Traffic capture %s dropped %d records", self.path, self.dropped)
+
+
+_capture = None
+_listening = False
+
+
+def _client_changed(client_id):
+    if _capture is not None:
+        _capture.client_changed(client_id)
+
+
+def start_capture(path):
+    """
+    Starts recording all client traffic of this process to a trace file at path. The
+    rows of every client are recorded first, then each change to them.
+    """
+    global _capture, _listening
+    if _capture is not None:
+        _capture.close()
+    _capture = TraceWriter(path)
+    for row in get_all_clients():
+        _capture.record_client(row)
+    if not _listening:
+        add_client_listener(_client_changed)
+        _listening = True
+    logging.info("Capturing client traffic to %s", path)
+    return _capture
+
+
+def get_capture():
+    """
+    Returns the running capture, or None when traffic is not captured.
+    """
+    return _capture
+
+
+def stop_capture():
+    """
+    Stops the running capture, if there is one.
+    """
+    global _capture
+    if _capture is not None:
+        _capture.close()
+        _capture = None
+
+
+atexit.register(stop_capture)
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+from dataBase import get_client, get_clients_version, add_client_listener
+from metrics import CLIENT_CACHE_LOOKUPS, CLIENT_CACHE_SESSIONS
+
+CACHE_SIZE = 4096  # Maximum number of client sessions kept in memory
+CACHE_TTL = 300.0  # Seconds before a cached session is reloaded from the database
+SHARED_CHECK_INTERVAL = 0.25  # Seconds between checks for changes made by other processes
+
+
+class ClientSession:
+    """
+    The cached view of one row of the clients table. The parsed public key is kept
+    by the key cache of crypt.py, keyed by the encoded key.
+    """
+    __slots__ = ('client_id', 'name', 'public_key', 'aes_key', 'expires')
+
+    def __init__(self, row, expires):
+        self.client_id, self.name, self.public_key, _, self.aes_key = row
+        self.expires = expires
+
+
+class ClientCache:
+    """
+    A bounded LRU cache of client sessions keyed by client ID, placed in front of the
+    clients table. Entries expire after a TTL and are dropped as soon as the database
+    reports a change to the client, so cached data never outlives an update made
+    through dataBase.py. Safe to use from several threads.
+
+    When several server processes share the database, set shared so the cache also
+    polls the clients table version and drops everything after another process
+    changed a client. Cached rows are then at most SHARED_CHECK_INTERVAL stale.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL, loader=get_client):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._loader = loader
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0  # Bumped on every invalidation to discard racing loads
+        self.shared = False
+        self._clients_version = None
+        self._next_check = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def peek(self, client_id):
+        """
+        Returns the cached session for client_id without touching the database,
+        or None if it is not cached.
+        """
+        with self._lock:
+            session = self._sessions.get(client_id)
+            if session is None or session.expires < time.monotonic():
+                return None
+            return session
+
+    def get(self, client_id):
+        """
+        Returns the session for client_id, loading it from the database on a miss.
+        Returns None for unknown clients; those are not cached.
+        """
+        now = time.monotonic()
+        if self.shared and now >= self._next_check:
+            self._check_shared_version(now)
+        with self._lock:
+            session = self._sessions.get(client_id)
+            if session is not None:
+                if session.expires >= now:
+                    self._sessions.move_to_end(client_id)
+                    self.hits += 1
+                    return session
+                del self._sessions[client_id]
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+
+        row = self._loader(client_id)
+        if row is None:
+            return None
+        session = ClientSession(row, now + self.ttl)
+        with self._lock:
+            if generation != self._generation:
+                # The client changed while it was being loaded, do not cache the old row
+                return session
+            self._sessions[client_id] = session
+            self._sessions.move_to_end(client_id)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+        return session
+
+    def _check_shared_version(self, now):
+        """
+        Clears the cache if another process changed the clients table since the
+        last check.
+        """
+        self._next_check = now + SHARED_CHECK_INTERVAL
+        version = get_clients_version()
+        if version != self._clients_version:
+            if self._clients_version is not None:
+                self.clear()
+            self._clients_version = version
+
+    def invalidate(self, client_id):
+        """
+        Drops the cached session of a client, if any.
+        """
+        with self._lock:
+            self._generation += 1
+            self._sessions.pop(client_id, None)
+
+    def clear(self):
+        """
+        Drops every cached session.
+        """
+        with self._lock:
+            self._generation += 1
+            self._sessions.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters as a dictionary, for logging and monitoring.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._sessions),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+client_cache = ClientCache()
+add_client_listener(client_cache.invalidate)
+CLIENT_CACHE_LOOKUPS.labels('hit').set_function(lambda: client_cache.stats()['hits'])
+CLIENT_CACHE_LOOKUPS.labels('miss').set_function(lambda: client_cache.stats()['misses'])
+CLIENT_CACHE_SESSIONS.set_function(lambda: client_cache.stats()['size'])
+
+
+def get_client_session(client_id):
+    """
+    Returns the cached session of a client, or None if the client is unknown.
+    """
+    return client_cache.get(client_id)
@@ -0,0 +1,144 @@
+import struct
+import zlib
+
+CKSUM_POLYNOMIAL = 0x04C11DB7  # POSIX cksum, processed most significant bit first
+ZLIB_MIN_SIZE = 64  # Below this the table-driven engine beats the zlib detour
+CHECKSUMS = ('crc32', 'cksum')
+_MASK = 0xFFFFFFFF
+_BIT_REVERSED = bytes(int(f'{value:08b}'[::-1], 2) for value in range(256))
+
+
+def _make_tables():
+    """
+    Builds the slice-by-8 lookup tables for the cksum polynomial. Table k holds the
+    CRC of each byte value followed by k zero bytes, table 0 is the classic
+    byte-at-a-time table.
+    """
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ CKSUM_POLYNOMIAL) if crc & 0x80000000 else crc << 1
+        table.append(crc & _MASK)
+    tables = [table]
+    for _ in range(7):
+        previous = tables[-1]
+        tables.append([((value << 8) & _MASK) ^ table[value >> 24] for value in previous])
+    return tuple(tuple(t) for t in tables)
+
+
+CKSUM_TABLES = _make_tables()
+CKSUM_TABLE = CKSUM_TABLES[0]
+
+
+def _cksum_bytewise(data, crc=0):
+    """
+    Table-driven cksum update, one byte at a time. This is the reference the faster
+    engines are checked against.
+    """
+    table = CKSUM_TABLE
+    for byte in bytes(data):
+        crc = ((crc << 8) & _MASK) ^ table[(crc >> 24) ^ byte]
+    return crc
+
+
+def _cksum_slice8(data, crc=0):
+    """
+    Slice-by-8 cksum update: eight bytes are folded into the CRC per step with eight
+    independent table lookups, the remaining bytes are processed one at a time.
+    """
+    t0, t1, t2, t3, t4, t5, t6, t7 = CKSUM_TABLES
+    data = memoryview(data).cast('B')
+    aligned = len(data) - len(data) % 8
+    for high, low in struct.iter_unpack('>II', data[:aligned]):
+        high ^= crc
+        crc = (t7[high >> 24] ^ t6[(high >> 16) & 0xFF] ^ t5[(high >> 8) & 0xFF] ^ t4[high & 0xFF] ^
+               t3[low >> 24] ^ t2[(low >> 16) & 0xFF] ^ t1[(low >> 8) & 0xFF] ^ t0[low & 0xFF])
+    return _cksum_bytewise(data[aligned:], crc)
+
+
+def _reverse_bits32(value):
+    """
+    Reverses the bit order of a 32-bit value.
+    """
+    return int(f'{value:032b}'[::-1], 2)
+
+
+def _cksum_zlib(data, crc=0):
+    """
+    cksum update computed by zlib. cksum uses the CRC-32 polynomial most significant
+    bit first while zlib.crc32 runs it least significant bit first, so reversing the
+    bits of every byte and of the register turns one into the other. zlib's start
+    and final inversions are undone through the value passed in and returned.
+    """
+    reflected = zlib.crc32(bytes(data).translate(_BIT_REVERSED), ~_reverse_bits32(crc) & _MASK)
+    return _reverse_bits32(~reflected & _MASK)
+
+
+def cksum_update(data, crc=0):
+    """
+    Continues a POSIX cksum over data and returns the new CRC register. Like
+    zlib.crc32, pass the previous result to checksum data that arrives in pieces;
+    the length is only mixed in by cksum_final().
+    """
+    if len(data) >= ZLIB_MIN_SIZE:
+        return _cksum_zlib(data, crc)
+    return _cksum_slice8(data, crc)
+
+
+def cksum_final(crc, length):
+    """
+    Completes a POSIX cksum: mixes in the total data length, least significant byte
+    first, and complements the result.
+    """
+    while length:
+        crc = ((crc << 8) & _MASK) ^ CKSUM_TABLE[(crc >> 24) ^ (length & 0xFF)]
+        length >>= 8
+    return ~crc & _MASK
+
+
+def cksum(data):
+    """
+    Returns the POSIX cksum of data, the value printed by the cksum command.
+    """
+    return cksum_final(cksum_update(data), len(data))
+
+
+def _crc32_final(crc, length):
+    """
+    zlib.crc32 values are complete as they are.
+    """
+    return crc
+
+
+_update = zlib.crc32
+_final = _crc32_final
+
+
+def configure_checksum(name):
+    """
+    Selects the checksum reported to clients in the file accepted response. 'crc32'
+    is the CRC-32 of zlib, which is what the C++ client computes with CryptoPP::CRC32;
+    'cksum' is the POSIX cksum for clients that follow the cksum specification.
+    """
+    global _update, _final
+    if name not in CHECKSUMS:
+        raise ValueError(f"Unknown checksum {name}, expected one of {', '.join(CHECKSUMS)}")
+    if name == 'cksum':
+        _update, _final = cksum_update, cksum_final
+    else:
+        _update, _final = zlib.crc32, _crc32_final
+
+
+def checksum_update(data, crc=0):
+    """
+    Continues the configured checksum over the next piece of data.
+    """
+    return _update(data, crc)
+
+
+def checksum_final(crc, length):
+    """
+    Completes the configured checksum of length bytes of data.
+    """
+    return _final(crc, length)
@@ -1,10 +1,28 @@
+import hashlib
+import struct
+import threading
+from collections import OrderedDict
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad, unpad
+from metrics import KEY_CACHE_LOOKUPS, KEY_CACHE_KEYS
 
 AES_KEY_SIZE = 32  # 256 bits
 RSA_KEY_SIZE = 1024  # 1024 bits
+KEY_CACHE_SIZE = 1024  # Parsed public keys kept in memory
+# Cipher suites of file transfers, sent in the 828 request by clients using
+# SEALED_VERSION. CBC encrypts the whole file as one stream; GCM seals every chunk
+# on its own with a nonce made of a random transfer nonce and the packet number.
+CIPHER_CBC, CIPHER_GCM = 0, 1
+CIPHER_NAMES = {CIPHER_CBC: 'aes-cbc', CIPHER_GCM: 'aes-gcm'}
+TRANSFER_NONCE_SIZE = 8  # Bytes of the random part of a GCM chunk nonce
+GCM_TAG_SIZE = 16  # Authentication tag at the end of every GCM chunk
+
+# Parsed public keys and their OAEP ciphers, keyed by the SHA-256 of the encoded key
+_key_cache = OrderedDict()
+_key_cache_lock = threading.Lock()
+_key_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
 
 def generate_aes_key():
     """
@@ -33,6 +51,108 @@ def decrypt_aes(data, key):
     cipher = AES.new(key, AES.MODE_CBC, iv)
     return unpad(cipher.decrypt(data[AES.block_size:]), AES.block_size)
 
+def decrypt_cbc(key, iv, ciphertext, final=False):
+    """
+    Decrypts a block aligned piece of an AES-CBC stream given the ciphertext block
+    that precedes it (or the IV for the first piece). Padding is removed when final
+    is set. Since it holds no state, pieces can be decrypted on any worker.
+    """
+    plaintext = AES.new(key, AES.MODE_CBC, iv).decrypt(ciphertext)
+    return unpad(plaintext, AES.block_size) if final else plaintext
+
+class AESStreamDecryptor:
+    """
+    Decrypts an AES-CBC stream (IV followed by ciphertext, as produced by encrypt_aes)
+    incrementally, so large files can be decrypted chunk by chunk as they arrive.
+    The CBC chaining state is carried between chunks and the last block is held back
+    until the final chunk so the padding can be removed.
+
+    split() only advances the chaining state and returns the (iv, ciphertext) pair
+    to pass to decrypt_cbc, which lets the decryption itself run elsewhere.
+    A stream can be continued later from the iv and pending bytes returned by state().
+    """
+
+    def __init__(self, key, iv=None, pending=b''):
+        self.key = key
+        self._iv = iv
+        self._pending = bytearray(pending)  # Received ciphertext that is not released yet
+
+    def state(self):
+        """
+        Returns (iv, pending) describing how far the stream got, so it can be
+        continued by a new decryptor after the connection is lost.
+        """
+        return self._iv, bytes(self._pending)
+
+    def split(self, data, final=False):
+        """
+        Feeds the next piece of the stream and returns (iv, ciphertext) for the blocks
+        that can be decrypted now. With final set every remaining block is returned;
+        its decryption must then remove the padding. Chunks do not need to be aligned
+        to the AES block size. Raises ValueError if a final stream is truncated.
+        """
+        if self._pending:
+            self._pending += data
+            data = self._pending
+        # Slices of the view are not copied, so the ciphertext is copied only once
+        view = memoryview(data).cast('B')
+        offset = 0
+        if self._iv is None:
+            if len(view) < AES.block_size:
+                if final:
+                    raise ValueError("Encrypted stream is truncated or not block aligned")
+                self._pending = bytearray(view)
+                return None, b''
+            self._iv = bytes(view[:AES.block_size])
+            offset = AES.block_size
+        available = len(view) - offset
+        if final:
+            if not available or available % AES.block_size:
+                raise ValueError("Encrypted stream is truncated or not block aligned")
+            ready = available
+        else:
+            # Keep an incomplete block, or the last full block which may hold the padding
+            ready = available - (available % AES.block_size or AES.block_size)
+            if ready <= 0:
+                self._pending = bytearray(view[offset:])
+                return self._iv, b''
+        iv = self._iv
+        ciphertext = bytes(view[offset:offset + ready])
+        self._pending = bytearray(view[offset + ready:])
+        self._iv = ciphertext[-AES.block_size:]
+        return iv, ciphertext
+
+def chunk_nonce(transfer_nonce, packet_number):
+    """
+    Builds the 12 byte GCM nonce of a file chunk. The transfer nonce is chosen at
+    random by the client for every transfer, so no nonce is used twice with a key.
+    """
+    return bytes(transfer_nonce) + struct.pack('>I', packet_number)
+
+def seal_chunk(plaintext, key, nonce, associated_data=b''):
+    """
+    Encrypts one file chunk with AES-GCM, as a client using CIPHER_GCM does, and
+    returns the ciphertext followed by the tag. associated_data is authenticated
+    but not encrypted.
+    """
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_SIZE)
+    cipher.update(associated_data)
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return ciphertext + tag
+
+def open_chunk(key, nonce, associated_data, sealed):
+    """
+    Decrypts and authenticates one AES-GCM file chunk. Every chunk stands on its
+    own, so chunks can be opened in any order and on any worker. Raises ValueError
+    if the chunk or its associated data was tampered with.
+    """
+    if len(sealed) < GCM_TAG_SIZE:
+        raise ValueError("Sealed chunk is shorter than its tag")
+    view = memoryview(sealed)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_SIZE)
+    cipher.update(associated_data)
+    return cipher.decrypt_and_verify(view[:-GCM_TAG_SIZE], view[-GCM_TAG_SIZE:])
+
 def generate_rsa_key():
     """
     Generates an RSA key pair for asymmetric encryption. This is typically used
@@ -41,15 +161,49 @@ def generate_rsa_key():
     """
     return RSA.generate(RSA_KEY_SIZE)
 
+def _cached_public_key(public_key):
+    """
+    Returns the (key object, OAEP cipher) pair for an encoded public key, parsing it
+    only if it is not in the bounded LRU key cache yet. Clients reconnecting with the
+    same key therefore skip the DER parsing entirely.
+    """
+    digest = hashlib.sha256(public_key).digest()
+    with _key_cache_lock:
+        entry = _key_cache.get(digest)
+        if entry is not None:
+            _key_cache.move_to_end(digest)
+            _key_cache_stats['hits'] += 1
+            return entry
+        _key_cache_stats['misses'] += 1
+
+    rsa_key = RSA.import_key(public_key)
+    entry = (rsa_key, PKCS1_OAEP.new(rsa_key))
+    with _key_cache_lock:
+        _key_cache[digest] = entry
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _key_cache.popitem(last=False)
+            _key_cache_stats['evictions'] += 1
+    return entry
+
+def key_cache_stats():
+    """
+    Returns the hit, miss and eviction counters of the public key cache.
+    """
+    with _key_cache_lock:
+        return dict(_key_cache_stats, size=len(_key_cache))
+
+KEY_CACHE_LOOKUPS.labels('hit').set_function(lambda: key_cache_stats()['hits'])
+KEY_CACHE_LOOKUPS.labels('miss').set_function(lambda: key_cache_stats()['misses'])
+KEY_CACHE_KEYS.set_function(lambda: key_cache_stats()['size'])
+
 def encrypt_aes_key(aes_key, public_key):
     """
     Encrypts an AES key using an RSA public key. This is used in the key exchange
     process, where the server needs to securely send an AES key to a client. The
-    AES key is encrypted with the client's public RSA key.
+    AES key is encrypted with the client's encoded public RSA key, which is parsed
+    only once while it stays in the key cache.
     """
-    rsa_key = RSA.import_key(public_key)
-    cipher = PKCS1_OAEP.new(rsa_key)
-    return cipher.encrypt(aes_key)
+    return _cached_public_key(bytes(public_key))[1].encrypt(aes_key)
 
 def decrypt_aes_key(encrypted_aes_key, private_key):
     """
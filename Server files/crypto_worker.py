@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from metrics import CRYPTO_SECONDS
+
+DEFAULT_MAX_PENDING = 256  # Jobs queued or running before submitters are held back
+OFFLOAD_MIN_SIZE = 16 * 1024  # Smaller bulk cipher jobs are cheaper to run inline
+
+
+class Deferred:
+    """
+    A response that becomes available once a crypto job has finished. The job runs on
+    the crypto stage; callback turns its result into the response bytes and errback
+    turns an exception into an error response. Both run on the thread that calls
+    resolve(), never on the worker.
+    """
+    __slots__ = ('future', 'callback', 'errback')
+
+    def __init__(self, future, callback, errback=None):
+        self.future = future
+        self.callback = callback
+        self.errback = errback
+
+    def done(self):
+        """
+        Tells whether the job has finished and resolve() will not block.
+        """
+        return self.future.done()
+
+    def resolve(self):
+        """
+        Waits for the job if needed and returns the response bytes.
+        """
+        try:
+            result = self.future.result()
+        except Exception as e:
+            if self.errback is None:
+                raise
+            return self.errback(e)
+        return self.callback(result)
+
+
+class CryptoStage:
+    """
+    A pool of crypto workers that takes jobs from the request handlers and returns
+    futures. A thread pool works well because PyCryptodome releases the GIL while it
+    runs its ciphers; a process pool also parallelizes the Python side of RSA.
+    At most max_pending jobs are accepted at a time. The selectors loop checks full
+    before taking more work from a connection, other callers block in submit().
+    """
+
+    def __init__(self, kind='thread', max_workers=None, max_pending=DEFAULT_MAX_PENDING):
+        if kind == 'process':
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='crypto-worker')
+        self.kind = kind
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.on_complete = None  # Called from the worker side whenever a job finished
+
+    @property
+    def pending(self):
+        """
+        Number of jobs that were submitted and have not finished yet.
+        """
+        return self._pending
+
+    @property
+    def full(self):
+        """
+        Tells whether the stage has no room for another job.
+        """
+        return self._pending >= self.max_pending
+
+    def submit(self, fn, *args):
+        """
+        Queues fn(*args) on a worker and returns its future. Blocks while the stage is
+        full, which is how backpressure reaches callers running on executor threads.
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._job_done(None)
+            raise
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _job_done(self, future):
+        """
+        Releases the slot of a finished job and notifies the server loop.
+        """
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+        if future is not None and self.on_complete is not None:
+            self.on_complete()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the workers, waiting for running jobs when wait is True.
+        """
+        self._executor.shutdown(wait=wait)
+
+
+_stage = None
+
+
+def configure_stage(kind='thread', max_workers=None, max_pending=DEFAULT_MAX_PENDING):
+    """
+    Creates the crypto stage used by the request handlers. With max_workers set to 0
+    no stage is used and all crypto runs inline on the calling thread.
+    """
+    global _stage
+    if _stage is not None:
+        _stage.shutdown(wait=False)
+    if max_workers == 0:
+        _stage = None
+    else:
+        _stage = CryptoStage(kind, max_workers or os.cpu_count(), max_pending)
+    return _stage
+
+
+def get_stage():
+    """
+    Returns the configured crypto stage, or None when crypto runs inline.
+    """
+    return _stage
+
+
+def offload(fn, args, callback, errback=None, size=None):
+    """
+    Runs fn(*args) on the crypto stage and returns a Deferred for the response that
+    callback builds from its result. Without a stage, or for bulk jobs smaller than
+    OFFLOAD_MIN_SIZE bytes, the job runs inline and the response is returned directly.
+    """
+    start = time.perf_counter()
+    if _stage is None or (size is not None and size < OFFLOAD_MIN_SIZE):
+        try:
+            result = fn(*args)
+        except Exception as e:
+            if errback is None:
+                raise
+            return errback(e)
+        finally:
+            CRYPTO_SECONDS.time_since(start)
+        return callback(result)
+    future = _stage.submit(fn, *args)
+    future.add_done_callback(lambda future: CRYPTO_SECONDS.time_since(start))
+    return Deferred(future, callback, errback)
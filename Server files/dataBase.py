@@ -1,7 +1,248 @@
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from metrics import DB_SECONDS
 
 DATABASE_NAME = 'defensive.db'
+POOL_SIZE = 8  # Maximum number of open connections shared by all threads
+STATEMENT_CACHE_SIZE = 64  # Prepared statements kept per connection
+BUSY_TIMEOUT = 5.0  # Seconds to wait for a lock held by another connection
+
+# SQL statements are kept as constants so every call reuses the same prepared statement
+SELECT_CLIENT = "SELECT * FROM clients WHERE id = ?"
+SELECT_CLIENT_BY_NAME = "SELECT * FROM clients WHERE name = ?"
+SELECT_ALL_CLIENTS = "SELECT * FROM clients"
+INSERT_CLIENT = "INSERT INTO clients (id, name, last_seen, aes_key) VALUES (?, ?, ?, ?)"
+UPDATE_CLIENT_KEY = "UPDATE clients SET public_key = ?, last_seen = ? WHERE id = ?"
+UPSERT_FILE = "INSERT OR REPLACE INTO files (id, file_name, path_name, verified, blob_hash) VALUES (?, ?, ?, ?, ?)"
+SELECT_FILE = "SELECT * FROM files WHERE id = ? AND file_name = ?"
+SELECT_FILE_BLOB = "SELECT blob_hash FROM files WHERE id = ? AND file_name = ?"
+ADD_BLOB_REFERENCE = "UPDATE blobs SET refcount = refcount + 1 WHERE hash = ?"
+INSERT_BLOB = "INSERT INTO blobs (hash, path, size, refcount) VALUES (?, ?, ?, 1)"
+RELEASE_BLOB = "UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?"
+SELECT_UNREFERENCED_BLOBS = "SELECT hash, path FROM blobs WHERE refcount <= 0"
+DELETE_UNREFERENCED_BLOB = "DELETE FROM blobs WHERE hash = ? AND refcount <= 0"
+SELECT_CLIENTS_VERSION = "SELECT version FROM clients_version WHERE id = 1"
+UPSERT_PARTIAL_UPLOAD = ("INSERT OR REPLACE INTO partial_uploads (id, file_name, temp_path, total_packets, "
+                         "content_size, orig_file_size, bitmap, received_size, iv, held, crc, size, cipher, updated) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+SELECT_PARTIAL_UPLOAD = ("SELECT temp_path, total_packets, content_size, orig_file_size, bitmap, received_size, "
+                         "iv, held, crc, size, cipher FROM partial_uploads WHERE id = ? AND file_name = ?")
+DELETE_PARTIAL_UPLOAD = "DELETE FROM partial_uploads WHERE id = ? AND file_name = ?"
+SELECT_STALE_PARTIAL_UPLOADS = "SELECT id, file_name, temp_path FROM partial_uploads WHERE updated < ?"
+SELECT_PARTIAL_UPLOAD_PATHS = "SELECT temp_path FROM partial_uploads"
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of persistent SQLite connections. Connections are opened lazily
+    in WAL journal mode, so readers never block the writer, and are handed out to one
+    thread at a time. This lets executor threads share a small number of connections
+    instead of opening a new one for every statement.
+    """
+
+    def __init__(self, database, size=POOL_SIZE):
+        self.database = database
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """
+        Opens a new connection configured for concurrent use.
+        """
+        conn = sqlite3.connect(self.database, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints and is still safe against corruption
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def acquire(self):
+        """
+        Takes a connection from the pool, opening a new one while the pool is not full
+        and waiting for a connection to be released otherwise.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool. Any transaction left open is rolled back.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        """
+        Closes every idle connection. Connections that are currently checked out are
+        closed by their users.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+
+_pool = ConnectionPool(DATABASE_NAME)
+# Holds the connection of a transaction() block for the thread that opened it
+_local = threading.local()
+# Callbacks invoked with a client ID whenever that client's row changes
+_client_listeners = []
+
+
+@contextmanager
+def connection():
+    """
+    Provides a pooled connection for the duration of a with block. Inside a
+    transaction() block the transaction's connection is reused.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+    conn = _pool.acquire()
+    try:
+        yield conn
+    finally:
+        _pool.release(conn)
+
+
+@contextmanager
+def transaction():
+    """
+    Groups several writes into a single commit. Write functions called inside the
+    block share one connection and are committed together when the block exits,
+    or rolled back if it raises. Nested blocks join the outer transaction.
+    The write lock is taken when the outermost block opens, so reads inside the
+    block see the state its writes are committed against.
+    """
+    if getattr(_local, 'conn', None) is not None:
+        yield _local.conn
+        return
+    conn = _pool.acquire()
+    _local.conn = conn
+    _local.changed_clients = []
+    try:
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        DB_SECONDS.time_since(start)
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        changed_clients = _local.changed_clients
+        _local.conn = None
+        _local.changed_clients = None
+        _pool.release(conn)
+    for client_id in changed_clients:
+        _notify_client_listeners(client_id)
+
+
+def _in_transaction():
+    """
+    Tells whether the calling thread is inside a transaction() block.
+    """
+    return getattr(_local, 'conn', None) is not None
+
+
+def _fetchone(sql, params):
+    """
+    Runs a query on a pooled connection and returns its first row.
+    """
+    start = time.perf_counter()
+    with connection() as conn:
+        row = conn.execute(sql, params).fetchone()
+    DB_SECONDS.time_since(start)
+    return row
+
+
+def _write(sql, params):
+    """
+    Runs a write statement and commits it, unless the caller groups writes with
+    transaction(), in which case the commit happens when that block ends.
+    Returns the number of rows changed.
+    """
+    start = time.perf_counter()
+    with connection() as conn:
+        rowcount = conn.execute(sql, params).rowcount
+        if not _in_transaction():
+            conn.commit()
+    DB_SECONDS.time_since(start)
+    return rowcount
+
+
+def add_client_listener(callback):
+    """
+    Registers a callback that is called with a client ID after that client's row was
+    added or changed. Caches of client data use this to drop stale entries.
+    """
+    _client_listeners.append(callback)
+
+
+def _notify_client_listeners(client_id):
+    """
+    Calls every registered client listener for client_id.
+    """
+    for callback in _client_listeners:
+        callback(client_id)
+
+
+def _client_changed(client_id):
+    """
+    Reports a change to a client's row. Inside a transaction() block the listeners
+    are only called once the changes are committed.
+    """
+    if _in_transaction():
+        _local.changed_clients.append(client_id)
+    else:
+        _notify_client_listeners(client_id)
+
+
+def configure_database(database=DATABASE_NAME, pool_size=POOL_SIZE):
+    """
+    Points the persistence layer at a database file, replacing the current pool.
+    This is used by tools and worker processes that must not share connections
+    with the process that created them.
+    """
+    global _pool
+    _pool.close()
+    _pool = ConnectionPool(database, pool_size)
+
+
+def close_database():
+    """
+    Closes the pooled connections. This is called on server shutdown.
+    """
+    _pool.close()
+
 
 def setup_database():
     """
@@ -9,15 +250,37 @@ def setup_database():
     This function sets up the structure for storing client information and file records.
     It's called when the server starts to ensure the database is ready for use.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS clients
-                 (id BLOB PRIMARY KEY, name TEXT UNIQUE, public_key BLOB, last_seen TEXT, aes_key BLOB)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS files
-                 (id BLOB, file_name TEXT, path_name TEXT, verified INTEGER, 
-                  PRIMARY KEY (id, file_name))''')
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS clients
+                     (id BLOB PRIMARY KEY, name TEXT UNIQUE, public_key BLOB, last_seen TEXT, aes_key BLOB)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS files
+                     (id BLOB, file_name TEXT, path_name TEXT, verified INTEGER, blob_hash TEXT,
+                      PRIMARY KEY (id, file_name))''')
+        if 'blob_hash' not in [column[1] for column in conn.execute("PRAGMA table_info(files)")]:
+            conn.execute("ALTER TABLE files ADD COLUMN blob_hash TEXT")
+        # Content-addressed store: one row per distinct file content, counting the
+        # files rows that refer to it
+        conn.execute('''CREATE TABLE IF NOT EXISTS blobs
+                     (hash TEXT PRIMARY KEY, path TEXT, size INTEGER, refcount INTEGER)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (refcount) WHERE refcount <= 0")
+        # A counter bumped on every change to the clients table, so processes that
+        # cache client rows can notice changes made by other processes
+        conn.execute('''CREATE TABLE IF NOT EXISTS clients_version
+                     (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER)''')
+        conn.execute("INSERT OR IGNORE INTO clients_version (id, version) VALUES (1, 0)")
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''CREATE TRIGGER IF NOT EXISTS clients_version_{event.lower()}
+                         AFTER {event} ON clients
+                         BEGIN UPDATE clients_version SET version = version + 1 WHERE id = 1; END''')
+        # Interrupted uploads: a bitmap of the chunks already on disk and the state
+        # needed to continue decrypting, so a reconnecting client only resends the rest
+        conn.execute('''CREATE TABLE IF NOT EXISTS partial_uploads
+                     (id BLOB, file_name TEXT, temp_path TEXT, total_packets INTEGER, content_size INTEGER,
+                      orig_file_size INTEGER, bitmap BLOB, received_size INTEGER, iv BLOB, held BLOB,
+                      crc INTEGER, size INTEGER, updated TEXT, cipher INTEGER DEFAULT 0,
+                      PRIMARY KEY (id, file_name))''')
+        if 'cipher' not in [column[1] for column in conn.execute("PRAGMA table_info(partial_uploads)")]:
+            conn.execute("ALTER TABLE partial_uploads ADD COLUMN cipher INTEGER DEFAULT 0")
 
 def get_client(client_id):
     """
@@ -25,12 +288,15 @@ def get_client(client_id):
     This is used to verify client identity and retrieve necessary information
     for handling client requests and file operations.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM clients WHERE id = ?", (client_id,))
-    client = c.fetchone()
-    conn.close()
-    return client
+    return _fetchone(SELECT_CLIENT, (client_id,))
+
+def get_all_clients():
+    """
+    Retrieves the rows of all clients. This is used by tools that copy the client
+    table, such as the traffic capture.
+    """
+    with connection() as conn:
+        return conn.execute(SELECT_ALL_CLIENTS).fetchall()
 
 def get_client_by_name(name):
     """
@@ -38,12 +304,7 @@ def get_client_by_name(name):
     This is particularly useful during the registration process to check
     if a username is already taken.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM clients WHERE name = ?", (name,))
-    client = c.fetchone()
-    conn.close()
-    return client
+    return _fetchone(SELECT_CLIENT_BY_NAME, (name,))
 
 def add_client(client_id, name, aes_key):
     """
@@ -51,16 +312,11 @@ def add_client(client_id, name, aes_key):
     successfully registers with the server. It stores the client's ID, username,
     and initial AES key.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
     try:
-        c.execute("INSERT INTO clients (id, name, last_seen, aes_key) VALUES (?, ?, ?, ?)",
-                  (client_id, name, datetime.now().isoformat(), aes_key))
-        conn.commit()
+        _write(INSERT_CLIENT, (client_id, name, datetime.now().isoformat(), aes_key))
     except sqlite3.IntegrityError:
-        conn.close()
         return False
-    conn.close()
+    _client_changed(client_id)
     return True
 
 def update_client_key(client_id, public_key):
@@ -69,45 +325,104 @@ def update_client_key(client_id, public_key):
     when a client reconnects or updates their encryption keys. It also updates
     the 'last_seen' timestamp for the client.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE clients SET public_key = ?, last_seen = ? WHERE id = ?",
-              (public_key, datetime.now().isoformat(), client_id))
-    conn.commit()
-    conn.close()
+    _write(UPDATE_CLIENT_KEY, (public_key, datetime.now().isoformat(), client_id))
+    _client_changed(client_id)
 
-def get_client_aes_key(client_id):
+def add_file(client_id, file_name, path_name, verified, blob_hash=None):
     """
-    Retrieves the AES key associated with a specific client. This key is used
-    for encrypting and decrypting data exchanged with the client.
+    Adds or updates a file record in the database. This is called when a client
+    uploads a file or when the status of a file changes (e.g., when it's verified).
+    Files kept in the content-addressed store also record the hash of their blob.
+    """
+    _write(UPSERT_FILE, (client_id, file_name, path_name, verified, blob_hash))
+
+def get_file_blob(client_id, file_name):
+    """
+    Returns the hash of the blob a file record refers to, or None.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("SELECT aes_key FROM clients WHERE id = ?", (client_id,))
-    result = c.fetchone()
-    conn.close()
+    result = _fetchone(SELECT_FILE_BLOB, (client_id, file_name))
     return result[0] if result else None
 
-def add_file(client_id, file_name, path_name, verified):
+def add_blob_reference(blob_hash, path, size):
     """
-    Adds or updates a file record in the database. This is called when a client
-    uploads a file or when the status of a file changes (e.g., when it's verified).
+    Counts a new reference to a blob, creating its row if it is not stored yet.
+    Returns True if the blob was new. Call it inside transaction() together with
+    moving the blob into place, so garbage collection cannot remove it in between.
+    """
+    if _write(ADD_BLOB_REFERENCE, (blob_hash,)):
+        return False
+    _write(INSERT_BLOB, (blob_hash, path, size))
+    return True
+
+def release_blob(blob_hash):
+    """
+    Drops one reference to a blob. Blobs left without references are removed by
+    the next garbage collection.
+    """
+    _write(RELEASE_BLOB, (blob_hash,))
+
+def get_unreferenced_blobs():
+    """
+    Lists (hash, path) of the blobs no file record refers to.
+    """
+    with connection() as conn:
+        return conn.execute(SELECT_UNREFERENCED_BLOBS).fetchall()
+
+def delete_unreferenced_blob(blob_hash):
+    """
+    Deletes the row of a blob if it is still unreferenced. Returns True if it was
+    deleted, in which case the caller removes the blob file.
+    """
+    return _write(DELETE_UNREFERENCED_BLOB, (blob_hash,)) > 0
+
+def get_clients_version():
+    """
+    Returns a number that changes whenever any process changes the clients table.
+    Worker processes compare it to decide when their client cache is stale.
+    """
+    result = _fetchone(SELECT_CLIENTS_VERSION, ())
+    return result[0] if result else 0
+
+def save_partial_upload(client_id, file_name, temp_path, total_packets, content_size, orig_file_size,
+                        bitmap, received_size, iv, held, crc, size, cipher=0):
+    """
+    Records how far an unfinished upload got, replacing any earlier record. bitmap
+    marks the chunks written to temp_path; iv, held, crc and size are the decryption
+    and checksum state after them, and cipher the cipher suite of the transfer.
+    """
+    _write(UPSERT_PARTIAL_UPLOAD, (client_id, file_name, temp_path, total_packets, content_size, orig_file_size,
+                                   bitmap, received_size, iv, held, crc, size, cipher, datetime.now().isoformat()))
+
+def get_partial_upload(client_id, file_name):
+    """
+    Retrieves the recorded state of an unfinished upload, or None if there is none.
+    """
+    return _fetchone(SELECT_PARTIAL_UPLOAD, (client_id, file_name))
+
+def delete_partial_upload(client_id, file_name):
+    """
+    Forgets an unfinished upload once it completed, failed or was restarted.
+    """
+    _write(DELETE_PARTIAL_UPLOAD, (client_id, file_name))
+
+def get_stale_partial_uploads(before):
+    """
+    Lists (client_id, file_name, temp_path) of unfinished uploads last updated
+    before the given datetime.
+    """
+    with connection() as conn:
+        return conn.execute(SELECT_STALE_PARTIAL_UPLOADS, (before.isoformat(),)).fetchall()
+
+def get_partial_upload_paths():
+    """
+    Lists the temporary file paths of all unfinished uploads that can be resumed.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO files (id, file_name, path_name, verified) VALUES (?, ?, ?, ?)",
-              (client_id, file_name, path_name, verified))
-    conn.commit()
-    conn.close()
+    with connection() as conn:
+        return [row[0] for row in conn.execute(SELECT_PARTIAL_UPLOAD_PATHS)]
 
 def get_file(client_id, file_name):
     """
     Retrieves information about a specific file associated with a client.
     This can be used to check if a file exists, its verification status, or its storage path.
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    c = conn.cursor()
-    c.execute("SELECT * FROM files WHERE id = ? AND file_name = ?", (client_id, file_name))
-    file = c.fetchone()
-    conn.close()
-    return file
\ No newline at end of file
+    return _fetchone(SELECT_FILE, (client_id, file_name))
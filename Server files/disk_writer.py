@@ -0,0 +1,84 @@
+import errno
+import logging
+import os
+from log_pipeline import RATE_LIMITED
+
+HAS_PWRITE = hasattr(os, 'pwrite')
+HAS_FALLOCATE = hasattr(os, 'posix_fallocate')
+_datasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class ChunkWriter:
+    """
+    Writes the content of an upload to a file descriptor at explicit offsets with
+    os.pwrite, without a Python level buffer, so every chunk is copied into the page
+    cache exactly once. Disk space can be reserved ahead of the writes, and syncs
+    are left to the caller so they can be batched.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._dirty = False  # Written since the last sync
+
+    @classmethod
+    def open(cls, path, create=False):
+        """
+        Opens path for writing, creating it if create is set, without truncating it.
+        """
+        flags = os.O_RDWR | getattr(os, 'O_BINARY', 0) | (os.O_CREAT if create else 0)
+        return cls(os.open(path, flags, 0o600))
+
+    def size(self):
+        """
+        Returns the current size of the file.
+        """
+        return os.fstat(self.fd).st_size
+
+    def preallocate(self, offset, length):
+        """
+        Reserves disk space for length bytes from offset, so the file system can lay
+        the file out in one piece and later writes never run out of space. This is
+        only a hint: where it is not supported or fails, the file grows as it is written.
+        """
+        if not HAS_FALLOCATE or length <= 0:
+            return
+        try:
+            os.posix_fallocate(self.fd, offset, length)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSPC):
+                raise
+            logging.debug("Could not preallocate %d bytes: %s", length, e, extra=RATE_LIMITED)
+
+    def write(self, data, offset):
+        """
+        Writes all of data, any bytes-like object, at offset.
+        """
+        view = memoryview(data).cast('B')
+        while view:
+            if HAS_PWRITE:
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+        self._dirty = True
+
+    def truncate(self, size):
+        """
+        Cuts the file to size bytes, dropping preallocated space past the content.
+        """
+        os.ftruncate(self.fd, size)
+        self._dirty = True
+
+    def sync(self):
+        """
+        Makes the data written so far durable. Does nothing if nothing was written
+        since the last sync.
+        """
+        if self._dirty:
+            _datasync(self.fd)
+            self._dirty = False
+
+    def close(self):
+        os.close(self.fd)
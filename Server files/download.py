@@ -0,0 +1,104 @@
+import mmap
+import os
+import time
+from crypt import seal_chunk, chunk_nonce, TRANSFER_NONCE_SIZE
+from metrics import CRYPTO_SECONDS, DOWNLOADS_IN_FLIGHT
+from protocol import download_chunk_prefix, create_download_chunk_header
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # File bytes sealed into one 1610 response
+
+
+class FileStream:
+    """
+    A download of a stored file, or of a range of it, produced one 1610 response at
+    a time. The file is memory mapped and every chunk is sealed with AES-GCM straight
+    from the mapping, so the content is never read into a Python buffer and only the
+    chunks waiting in the output queue are held in memory. The server pulls the next
+    chunk only once the connection's output drained, so a slow client never makes
+    the server read ahead.
+    """
+
+    def __init__(self, client_id, file_name, path, aes_key, offset=0, length=0):
+        """
+        Opens the file at path for sending length bytes from offset, or everything
+        from offset with a length of 0; a range past the end is cut at the end.
+        Raises ValueError if offset is past the end of the file. The file stays
+        readable while it is sent, even if its blob is removed in the meantime.
+        """
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            file_size = os.fstat(fd).st_size
+            if offset > file_size:
+                raise ValueError(f"Offset {offset} is past the end of {file_name} ({file_size} bytes)")
+            end = file_size if not length else min(file_size, offset + length)
+            total_packets = max(1, (end - offset + DOWNLOAD_CHUNK_SIZE - 1) // DOWNLOAD_CHUNK_SIZE)
+            if total_packets > 0xFFFF:
+                raise ValueError(f"A range of {end - offset} bytes needs more than 65535 chunks")
+            file_map = None
+            if end > offset:
+                file_map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                if hasattr(file_map, 'madvise'):
+                    file_map.madvise(mmap.MADV_SEQUENTIAL)
+        except Exception:
+            os.close(fd)
+            raise
+        self.client_id = client_id
+        self.file_name = file_name
+        self.key = aes_key
+        self.file_size = file_size
+        self.offset = offset
+        self.end = end
+        self.total_packets = total_packets
+        self.packet_number = 0  # Chunks produced so far
+        self.transfer_nonce = os.urandom(TRANSFER_NONCE_SIZE)
+        self._fd = fd
+        self._map = file_map
+        self._view = memoryview(file_map) if file_map is not None else None
+        DOWNLOADS_IN_FLIGHT.inc()
+
+    @property
+    def done(self):
+        """
+        Tells whether every chunk of the download was produced.
+        """
+        return self.packet_number >= self.total_packets
+
+    def next_chunk(self):
+        """
+        Seals the next chunk and returns the buffers of its 1610 response, header
+        first, to be queued without joining them. Returns an empty tuple once done.
+        The file is closed after the last chunk.
+        """
+        if self.done:
+            return ()
+        self.packet_number += 1
+        start = self.offset + (self.packet_number - 1) * DOWNLOAD_CHUNK_SIZE
+        stop = min(self.end, start + DOWNLOAD_CHUNK_SIZE)
+        prefix = download_chunk_prefix(self.client_id, self.file_name, self.file_size, start,
+                                       self.packet_number, self.total_packets, self.transfer_nonce)
+        nonce = chunk_nonce(self.transfer_nonce, self.packet_number)
+        timer = time.perf_counter()
+        if self._view is not None:
+            # Pages of the file are faulted in as the cipher reads them
+            with self._view[start:stop] as content:
+                sealed = seal_chunk(content, self.key, nonce, prefix)
+        else:
+            sealed = seal_chunk(b'', self.key, nonce, prefix)
+        CRYPTO_SECONDS.time_since(timer)
+        if self.done:
+            self.close()
+        return create_download_chunk_header(len(prefix) + len(sealed)) + prefix, sealed
+
+    def close(self):
+        """
+        Releases the mapping and the file. Safe to call more than once.
+        """
+        if self._fd is None:
+            return
+        if self._view is not None:
+            self._view.release()
+            self._map.close()
+            self._view = self._map = None
+        os.close(self._fd)
+        self._fd = None
+        DOWNLOADS_IN_FLIGHT.dec()
@@ -0,0 +1,106 @@
+import lzma
+import zlib
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+# Compression methods of the 828 request, sent in the byte after the file name by
+# clients using COMPRESSED_VERSION
+NONE, ZLIB, LZMA, ZSTD = 0, 1, 2, 3
+METHOD_NAMES = {NONE: 'none', ZLIB: 'zlib', LZMA: 'lzma', ZSTD: 'zstd'}
+OUTPUT_BLOCK = 256 * 1024  # Most bytes a decompressor produces per step
+
+
+def available_methods():
+    """
+    Returns the compression methods this server can decompress. zstd needs the
+    compression.zstd module of Python 3.14, or the backports.zstd package.
+    """
+    methods = [NONE, ZLIB, LZMA]
+    if zstd is not None:
+        methods.append(ZSTD)
+    return methods
+
+
+class StreamDecompressor:
+    """
+    Decompresses a compressed stream piece by piece as its chunks arrive. Output is
+    produced in blocks of at most OUTPUT_BLOCK bytes and limited to the announced
+    size of the file, so a small chunk cannot expand into unbounded memory.
+    """
+
+    def __init__(self, method, limit):
+        self.method = method
+        self.remaining = limit
+        if method == ZLIB:
+            self._decompressor = zlib.decompressobj()
+        elif method == LZMA:
+            self._decompressor = lzma.LZMADecompressor()
+        elif method == ZSTD and zstd is not None:
+            self._decompressor = zstd.ZstdDecompressor()
+        else:
+            raise ValueError(f"Unsupported compression method {method}")
+
+    def decompress(self, data):
+        """
+        Yields the decompressed blocks of the next piece of the stream. Raises
+        ValueError when the stream is corrupt or larger than announced.
+        """
+        try:
+            if self.method == ZLIB:
+                while data:
+                    block = self._decompressor.decompress(data, OUTPUT_BLOCK)
+                    data = self._decompressor.unconsumed_tail
+                    yield self._checked(block)
+            else:
+                # LZMA and zstd keep unconsumed input themselves until asked for more output
+                block = self._decompressor.decompress(data, OUTPUT_BLOCK)
+                yield self._checked(block)
+                while not self._decompressor.eof and not self._decompressor.needs_input:
+                    yield self._checked(self._decompressor.decompress(b'', OUTPUT_BLOCK))
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Corrupt {METHOD_NAMES[self.method]} stream: {e}")
+        except Exception as e:
+            if zstd is not None and isinstance(e, zstd.ZstdError):
+                raise ValueError(f"Corrupt zstd stream: {e}")
+            raise
+
+    def finish(self):
+        """
+        Returns what is left once the whole stream was fed, and raises ValueError if
+        the stream ended early.
+        """
+        if self.method == ZLIB:
+            rest = self._checked(self._decompressor.flush())
+            if not self._decompressor.eof:
+                raise ValueError("Compressed stream is truncated")
+            return rest
+        if self.method in (LZMA, ZSTD) and not self._decompressor.eof:
+            raise ValueError("Compressed stream is truncated")
+        return b''
+
+    def _checked(self, block):
+        self.remaining -= len(block)
+        if self.remaining < 0:
+            raise ValueError("Decompressed content is larger than the announced file size")
+        return block
+
+
+def compress(data, method, level=None):
+    """
+    Compresses a whole file for sending with the given method, as a client does.
+    """
+    if method == ZLIB:
+        return zlib.compress(data, 6 if level is None else level)
+    if method == LZMA:
+        return lzma.compress(data, preset=6 if level is None else level)
+    if method == ZSTD and zstd is not None:
+        return zstd.compress(data, level=3 if level is None else level)
+    if method == NONE:
+        return data
+    raise ValueError(f"Unsupported compression method {method}")
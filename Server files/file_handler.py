@@ -1,9 +1,29 @@
 import os
-import zlib
+import hashlib
 import re
 import logging
-from dataBase import add_file
-from protocol import create_file_accepted, create_general_error, create_message_accepted
+import tempfile
+import time
+from datetime import datetime, timedelta
+from dataBase import (transaction, add_file, save_partial_upload, get_partial_upload, delete_partial_upload,
+                      get_stale_partial_uploads, get_partial_upload_paths, get_file_blob, add_blob_reference,
+                      release_blob, get_unreferenced_blobs, delete_unreferenced_blob)
+from crypt import AESStreamDecryptor, CIPHER_CBC
+from disk_writer import ChunkWriter
+from file_compression import METHOD_NAMES, StreamDecompressor
+from crc import checksum_update, checksum_final
+from metrics import DISK_SECONDS, UPLOADS_IN_FLIGHT, COMPRESSED_BYTES, DECOMPRESSED_BYTES, COMPRESSION_RATIO
+from scheduler import UploadLimitReached, start_upload, end_upload
+from protocol import create_file_accepted, create_general_error, create_file_info, chunk_bitmap, contiguous_packets
+
+UPLOAD_DIR = 'uploads'
+BLOB_DIR = os.path.join(UPLOAD_DIR, 'blobs')  # Content-addressed store, one file per distinct content
+DELETED_SUFFIX = '.deleted'  # Blob files moved aside while their row is deleted
+PART_SUFFIX = '.part'  # Temporary files that uploads are written to until they complete
+CHECKPOINT_INTERVAL = 256  # Chunks between two saved resume points of an upload
+PARTIAL_UPLOAD_TTL = timedelta(days=7)  # Interrupted uploads not resumed within this time are deleted
+PREALLOCATE_STEP = 8 * 1024 * 1024  # Disk space reserved ahead of the content written to an upload
+
 
 def safe_filename(filename):
     """
@@ -11,61 +31,420 @@ def safe_filename(filename):
     """
     return re.sub(r'[^\w\-_\. ]', '_', filename)
 
-def process_file_content(client_id, data):
+
+def open_upload(client_id, file_name, aes_key, size=0, compression=0, cipher=CIPHER_CBC):
     """
-    Processes received file content and saves it to disk. This function handles both partial
-    and complete file transfers, updating the file on disk accordingly.
+    Prepares the streaming state for a new file transfer. Decrypted content is written
+    to a temporary file in the upload directory, so that the completed file can be
+    moved into the blob store atomically and a half received file is never visible.
+    Disk space is reserved in steps of PREALLOCATE_STEP as content arrives, up to size
+    bytes, the announced file size, so an upload only holds space for data it sent.
+    Content compressed with the given method is decompressed as it arrives, and
+    cipher is the cipher suite the content is encrypted with.
+    Raises UploadLimitReached if the client has too many uploads open.
+    """
+    if not os.path.exists(UPLOAD_DIR):
+        os.makedirs(UPLOAD_DIR)
+
+    safe_name = safe_filename(file_name)
+    if safe_name != file_name:
+        logging.warning("File name was sanitized. Original: %s, Sanitized: %s", file_name, safe_name)
+
+    start_upload(client_id)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=f".{client_id.hex()}_", suffix=PART_SUFFIX)
+    except OSError:
+        end_upload(client_id)
+        raise
+    UPLOADS_IN_FLIGHT.inc()
+    file = ChunkWriter(fd)
+    upload = _upload_state(client_id, file_name, temp_path, file, aes_key, cipher, expected_size=size)
+    if compression:
+        upload['decompressor'] = StreamDecompressor(compression, size)
+    return upload
+
+
+def _upload_state(client_id, file_name, temp_path, file, aes_key, cipher, iv=None, held=b'', expected_size=0):
+    """
+    Builds the streaming state of an upload whose decrypted content goes to file,
+    a ChunkWriter, and is expected to be expected_size bytes long. A CBC stream is decrypted with an AESStreamDecryptor continuing
+    from iv and held. Other cipher suites authenticate every chunk, so no checksum
+    is computed for them.
+    """
+    safe_name = safe_filename(file_name)
+    return {
+        'client_id': client_id,
+        'name': file_name,
+        'file_name': safe_name,
+        'temp_path': temp_path,
+        'file': file,
+        'key': aes_key,
+        'cipher': cipher,
+        'decryptor': AESStreamDecryptor(aes_key, iv, held) if cipher == CIPHER_CBC else None,
+        'crc': 0 if cipher == CIPHER_CBC else None,
+        'hash': hashlib.sha256(),  # Content hash, the key of the file in the blob store
+        'size': 0,
+        'expected_size': expected_size,
+        'allocated': 0,  # Bytes of the file reserved with preallocate()
+        'resume_point': None,  # State after the last chunk written, see mark_resume_point()
+        'saved_packets': 0,    # Chunks covered by the resume point saved in the database
+        'suspended': False,
+        'decompressor': None,   # StreamDecompressor of a compressed upload
+        'compressed_size': 0    # Decrypted bytes fed to the decompressor
+    }
+
 
-    When the final chunk is received, it performs a CRC check on the complete file
-    and updates the database with the file information.
+def write_upload_chunk(upload, plaintext):
+    """
+    Writes the next piece of decrypted content to the temporary file of an upload,
+    decompressing it first if the upload is compressed.
     """
-    if not os.path.exists('uploads'):
-        os.makedirs('uploads')
+    decompressor = upload['decompressor']
+    if decompressor is None:
+        _write_content(upload, plaintext)
+        return
+    upload['compressed_size'] += len(plaintext)
+    for block in decompressor.decompress(plaintext):
+        _write_content(upload, block)
 
-    safe_name = safe_filename(data['file_name'])
-    if safe_name != data['file_name']:
-        logging.warning(f"File name was sanitized. Original: {data['file_name']}, Sanitized: {safe_name}")
 
-    file_path = os.path.join('uploads', f"{client_id.hex()}_{safe_name}")
+def _write_content(upload, plaintext):
+    """
+    Writes content right after the content written so far and updates the running
+    CRC and content hash, so only one chunk is ever held in memory.
+    """
+    if plaintext:
+        start = time.perf_counter()
+        if upload['size'] + len(plaintext) > upload['allocated']:
+            _reserve_space(upload, upload['size'] + len(plaintext))
+        upload['file'].write(plaintext, upload['size'])
+        DISK_SECONDS.time_since(start)
+        if upload['crc'] is not None:
+            upload['crc'] = checksum_update(plaintext, upload['crc'])
+        upload['hash'].update(plaintext)
+        upload['size'] += len(plaintext)
 
-    try:
-        with open(file_path, 'ab') as f:
-            f.write(data['content'])
 
-        if data['packet_number'] == data['total_packets']:
-            # File transfer complete, verify CRC
-            with open(file_path, 'rb') as f:
-                file_content = f.read()
-            crc = zlib.crc32(file_content)
+def _reserve_space(upload, end):
+    """
+    Reserves disk space for the content up to end and up to PREALLOCATE_STEP bytes
+    past it, never past the announced size.
+    """
+    target = min(upload['expected_size'], end + PREALLOCATE_STEP)
+    if target > upload['allocated']:
+        upload['file'].preallocate(upload['allocated'], target - upload['allocated'])
+    upload['allocated'] = max(target, end)
 
-            if len(file_content) != data['orig_file_size']:
-                logging.warning(f"File size mismatch. Expected: {data['orig_file_size']}, Got: {len(file_content)}")
-                return create_general_error(client_id)
 
-            add_file(client_id, safe_name, file_path, 1)
-            return create_file_accepted(client_id, len(file_content), safe_name, crc)
+def finish_upload(upload):
+    """
+    Closes the temporary file of a completely written upload once its content is on
+    disk, dropping space preallocated past the content. Returns the size of the
+    decrypted file. Raises ValueError if a compressed upload ended early.
+    """
+    decompressor = upload['decompressor']
+    if decompressor is not None:
+        _write_content(upload, decompressor.finish())
+        method = METHOD_NAMES[decompressor.method]
+        COMPRESSED_BYTES.labels(method).inc(upload['compressed_size'])
+        DECOMPRESSED_BYTES.labels(method).inc(upload['size'])
+        if upload['compressed_size']:
+            COMPRESSION_RATIO.labels(method).observe(upload['size'] / upload['compressed_size'])
+    start = time.perf_counter()
+    upload['file'].truncate(upload['size'])
+    upload['file'].sync()
+    upload['file'].close()
+    upload['file'] = None
+    DISK_SECONDS.time_since(start)
+    UPLOADS_IN_FLIGHT.dec()
+    end_upload(upload['client_id'])
+    return upload['size']
+
+
+def commit_upload(upload):
+    """
+    Stores a finished upload in the content-addressed blob store and points the
+    client's file record at it. If the same content is already stored, only the
+    record is written and the temporary file is dropped. The blob the record
+    referred to before loses a reference. Returns the path of the blob.
+    """
+    blob_hash = upload['hash'].hexdigest()
+    blob_path = os.path.join(BLOB_DIR, blob_hash[:2], blob_hash)
+    client_id = upload['client_id']
+    with transaction():
+        previous_hash = get_file_blob(client_id, upload['file_name'])
+        is_new = add_blob_reference(blob_hash, blob_path, upload['size'])
+        if is_new or not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(upload['temp_path'], blob_path)
         else:
-            return create_message_accepted(client_id)  # Acknowledge partial upload
+            logging.info("%s from %s is a duplicate of blob %s", upload['file_name'], client_id.hex(), blob_hash)
+            os.remove(upload['temp_path'])
+        add_file(client_id, upload['file_name'], blob_path, 1, blob_hash)
+        if previous_hash is not None:
+            release_blob(previous_hash)
+        if upload['saved_packets']:
+            upload['saved_packets'] = 0
+            delete_partial_upload(client_id, upload['name'])
+    if previous_hash is not None and previous_hash != blob_hash:
+        collect_blobs()
+    return blob_path
 
-    except IOError as e:
-        logging.error(f"Error writing file {file_path}: {str(e)}")
-        return create_general_error(client_id)
-    except Exception as e:
-        logging.error(f"Unexpected error processing file content: {str(e)}")
-        return create_general_error(client_id)
 
-def calculate_crc(file_path):
+def collect_blobs():
     """
-    Calculates the CRC32 checksum of a file. This function is used to verify the
-    integrity of uploaded files.
+    Removes the blobs that no file record refers to any more. Inside one transaction
+    each row is deleted and its file moved aside; the files are only removed once
+    the transaction committed, and moved back if it failed. An upload of the same
+    content either keeps the blob referenced or, after the commit, stores a fresh
+    copy that the removal does not touch.
     """
+    removed = 0
+    doomed = []
     try:
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
-        return zlib.crc32(file_content)
-    except IOError as e:
-        logging.error(f"Error reading file {file_path} for CRC calculation: {str(e)}")
+        with transaction():
+            for blob_hash, path in get_unreferenced_blobs():
+                if delete_unreferenced_blob(blob_hash):
+                    removed += 1
+                    try:
+                        os.replace(path, path + DELETED_SUFFIX)
+                    except FileNotFoundError:
+                        continue
+                    doomed.append(path)
+    except BaseException:
+        for path in doomed:
+            os.replace(path + DELETED_SUFFIX, path)
+        raise
+    for path in doomed:
+        os.remove(path + DELETED_SUFFIX)
+    if removed:
+        logging.info("Removed %d unreferenced blobs", removed)
+    return removed
+
+
+def abort_upload(upload):
+    """
+    Discards an unfinished upload and removes its temporary file.
+    """
+    if upload['file'] is not None:
+        upload['file'].close()
+        upload['file'] = None
+        UPLOADS_IN_FLIGHT.dec()
+        end_upload(upload['client_id'])
+    try:
+        os.remove(upload['temp_path'])
+    except FileNotFoundError:
+        pass
+    if upload['saved_packets']:
+        upload['saved_packets'] = 0
+        delete_partial_upload(upload['client_id'], upload['name'])
+
+
+def mark_resume_point(data):
+    """
+    Remembers the state of an upload right after its latest chunk was written: the
+    chunks on disk, the decryption state and the checksum. The resume point is saved
+    to the database every CHECKPOINT_INTERVAL chunks and when the client disconnects.
+    Compressed uploads have no resume points, the decompressor state cannot be saved.
+    """
+    upload = data['upload']
+    if not data['received_packets'] or upload['decompressor'] is not None:
+        return
+    iv, held = upload['decryptor'].state() if upload['decryptor'] is not None else (None, b'')
+    upload['resume_point'] = (data['received_packets'], data['received_size'], iv, held, upload['crc'], upload['size'])
+    if data['received_packets'] - upload['saved_packets'] >= CHECKPOINT_INTERVAL:
+        save_resume_point(data)
+
+
+def save_resume_point(data):
+    """
+    Writes the latest resume point of an upload to the database. The temporary file
+    is synced first, so the data the record refers to is on disk; this is the only
+    sync before the upload finishes.
+    """
+    upload = data['upload']
+    received_packets, received_size, iv, held, crc, size = upload['resume_point']
+    upload['file'].sync()
+    save_partial_upload(upload['client_id'], upload['name'], upload['temp_path'], data['total_packets'],
+                        data['content_size'], data['orig_file_size'],
+                        chunk_bitmap(data['total_packets'], received_packets), received_size, iv, held, crc, size,
+                        upload['cipher'])
+    upload['saved_packets'] = received_packets
+
+
+def suspend_uploads(file_data):
+    """
+    Keeps the unfinished uploads of a disconnected client on disk so they can be
+    resumed, and discards those that have nothing written yet.
+    """
+    for entry in file_data.values():
+        upload = entry.get('upload')
+        if upload is None:
+            continue
+        if upload['file'] is None or upload['resume_point'] is None:
+            abort_upload(upload)
+            continue
+        try:
+            save_resume_point(entry)
+        except Exception as e:
+            logging.error("Could not save the resume point of %s: %s", upload['file_name'], e)
+            abort_upload(upload)
+            continue
+        # Space reserved past the resume point is not held while the upload waits
+        upload['file'].truncate(upload['resume_point'][5])
+        upload['file'].close()
+        upload['file'] = None
+        UPLOADS_IN_FLIGHT.dec()
+        end_upload(upload['client_id'])
+        upload['suspended'] = True
+        logging.info("Upload of %s interrupted after %d chunks, kept for resuming", upload['file_name'],
+                     upload['saved_packets'])
+    file_data.clear()
+
+
+def resume_upload(client_id, file_name, aes_key):
+    """
+    Restores an interrupted upload from its saved resume point. Returns the transfer
+    bookkeeping entry with the reopened upload, or None if there is nothing usable
+    to resume. Raises UploadLimitReached if the client has too many uploads open.
+    """
+    row = get_partial_upload(client_id, file_name)
+    if row is None:
+        return None
+    temp_path, total_packets, content_size, orig_file_size, bitmap, received_size, iv, held, crc, size, cipher = row
+    try:
+        file = ChunkWriter.open(temp_path)
+    except OSError:
+        file = None
+    if file is None or file.size() < size:
+        logging.warning("Partial upload %s is missing or incomplete, the upload starts over", temp_path)
+        if file is not None:
+            file.close()
+        discard_partial_upload(client_id, file_name)
+        return None
+    try:
+        start_upload(client_id)
+    except UploadLimitReached:
+        file.close()
+        raise
+    # Anything written after the resume point is sent again by the client
+    file.truncate(size)
+    UPLOADS_IN_FLIGHT.inc()
+
+    received_packets = contiguous_packets(bitmap, total_packets)
+    upload = _upload_state(client_id, file_name, temp_path, file, aes_key, cipher, iv, held, orig_file_size)
+    # The hash state cannot be saved, so the content hash is rebuilt from the content
+    # written before the resume point
+    with open(temp_path, 'rb') as content:
+        remaining = size
+        while remaining:
+            block = content.read(min(64 * 1024, remaining))
+            if not block:
+                break
+            upload['hash'].update(block)
+            remaining -= len(block)
+    upload['crc'] = crc
+    upload['size'] = upload['allocated'] = size
+    upload['resume_point'] = (received_packets, received_size, iv, held, crc, size)
+    upload['saved_packets'] = received_packets
+    data = create_file_info(total_packets, content_size, orig_file_size, cipher=cipher)
+    data['received_packets'] = data['acked_packets'] = received_packets
+    data['received_size'] = received_size
+    data['upload'] = upload
+    logging.info("Resuming upload of %s after %d of %d chunks", upload['file_name'], received_packets, total_packets)
+    return data
+
+
+def discard_partial_upload(client_id, file_name):
+    """
+    Deletes the saved state and the temporary file of an interrupted upload, if
+    there is one. This is called when a client starts the same upload over.
+    """
+    row = get_partial_upload(client_id, file_name)
+    if row is None:
+        return
+    try:
+        os.remove(row[0])
+    except FileNotFoundError:
+        pass
+    delete_partial_upload(client_id, file_name)
+
+
+def discard_stale_uploads(max_age=PARTIAL_UPLOAD_TTL):
+    """
+    Deletes interrupted uploads that were not resumed within max_age. This is called
+    when the server starts and periodically while it runs.
+    """
+    for client_id, file_name, temp_path in get_stale_partial_uploads(datetime.now() - max_age):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        delete_partial_upload(client_id, file_name)
+    _discard_orphan_temp_files(max_age)
+
+
+def _discard_orphan_temp_files(max_age):
+    """
+    Deletes temporary upload files that no saved upload refers to and that were not
+    written to within max_age. They are left behind when the server stops during an
+    upload that never reached a resume point.
+    """
+    try:
+        entries = list(os.scandir(UPLOAD_DIR))
+    except FileNotFoundError:
+        return
+    before = time.time() - max_age.total_seconds()
+    referenced = {os.path.abspath(path) for path in get_partial_upload_paths()}
+    removed = 0
+    for entry in entries:
+        if not entry.name.startswith('.') or not entry.name.endswith(PART_SUFFIX) or not entry.is_file():
+            continue
+        if os.path.abspath(entry.path) in referenced:
+            continue
+        try:
+            if entry.stat().st_mtime >= before:
+                continue  # Possibly an upload still in progress
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+    if removed:
+        logging.info("Removed %d orphaned temporary upload files", removed)
+
+
+def process_file_content(client_id, data, plaintext):
+    """
+    Processes decrypted file content and streams it to disk. This function handles both partial
+    and complete file transfers, updating the file on disk accordingly.
+
+    When the final chunk is received, it checks the size of the complete file, moves it into
+    place and updates the database with the file information and its CRC. Uploads without a
+    CRC, whose chunks were authenticated, report 0. Returns None for a chunk that was stored
+    without completing the file; the caller acknowledges it.
+    """
+    upload = data['upload']
+    try:
+        write_upload_chunk(upload, plaintext)
+
+        if data['received_packets'] == data['total_packets']:
+            # File transfer complete, finalize and verify the size before moving it into place
+            file_size = finish_upload(upload)
+            if file_size != data['orig_file_size']:
+                logging.warning("File size mismatch. Expected: %d, Got: %d", data['orig_file_size'], file_size)
+                abort_upload(upload)
+                return create_general_error(client_id)
+
+            commit_upload(upload)
+            cksum = checksum_final(upload['crc'], upload['size']) if upload['crc'] is not None else 0
+            return create_file_accepted(client_id, upload['size'], upload['file_name'], cksum)
         return None
+
+    except IOError as e:
+        logging.error("Error writing file %s: %s", upload['file_name'], e)
+        abort_upload(upload)
+        return create_general_error(client_id)
     except Exception as e:
-        logging.error(f"Unexpected error calculating CRC: {str(e)}")
-        return None
\ No newline at end of file
+        logging.error("Unexpected error processing file content: %s", e)
+        abort_upload(upload)
+        return create_general_error(client_id)
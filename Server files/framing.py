@@ -0,0 +1,117 @@
+from protocol import REQUEST_HEADER_SIZE, parse_request_header
+
+# Initial receive buffer size per connection; grows on demand for larger frames and
+# returns to this size once they were consumed
+DEFAULT_BUFFER_SIZE = 64 * 1024
+# Upper bound for a single request payload, protects the server from bogus sizes
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+# Minimum free space offered to a single recv_into() call
+MIN_READ_SIZE = 4096
+
+
+class FrameDecoder:
+    """
+    Incremental request decoder for a single connection. Bytes received from the socket
+    are accumulated in a preallocated buffer and only complete frames (header + payload)
+    are handed out, so short reads never desynchronize the stream and several pipelined
+    requests arriving in one read are all processed.
+
+    Payloads are returned as memoryview slices of the receive buffer. They stay valid
+    until the next call to recv_into() or feed(); callers that need the data longer
+    must copy it.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_payload_size=MAX_PAYLOAD_SIZE):
+        self._buffer = bytearray(max(buffer_size, REQUEST_HEADER_SIZE))
+        self._buffer_size = len(self._buffer)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Offset of the first unconsumed byte
+        self._end = 0    # Offset one past the last received byte
+        self._wanted = 0  # Bytes still missing to complete the frame at _start
+        self.max_payload_size = max_payload_size
+
+    @property
+    def buffered(self):
+        """
+        Number of received bytes that have not yet been returned as part of a frame.
+        """
+        return self._end - self._start
+
+    @property
+    def frame_ready(self):
+        """
+        Tells whether a complete frame is buffered.
+        """
+        if self._end - self._start < REQUEST_HEADER_SIZE:
+            return False
+        payload_size = parse_request_header(self._buffer, self._start)[3]
+        return self._end - self._start >= REQUEST_HEADER_SIZE + payload_size
+
+    def recv_into(self, sock):
+        """
+        Reads as much data as fits into the free part of the buffer directly from the
+        socket, without intermediate copies. Returns the number of bytes read, which
+        is 0 when the peer closed the connection.
+        """
+        self._make_room(max(self._wanted, MIN_READ_SIZE))
+        count = sock.recv_into(self._view[self._end:])
+        self._end += count
+        return count
+
+    def feed(self, data):
+        """
+        Appends already received data to the buffer. This is used by transports that
+        deliver bytes themselves instead of exposing a socket.
+        """
+        size = len(data)
+        self._make_room(max(self._wanted, size))
+        self._view[self._end:self._end + size] = data
+        self._end += size
+
+    def frames(self):
+        """
+        Yields every complete frame currently buffered as a tuple of
+        (client_id, version, code, payload). Incomplete trailing data is kept for the
+        next read. Raises ValueError if a header announces an oversized payload.
+        """
+        while self._end - self._start >= REQUEST_HEADER_SIZE:
+            client_id, version, code, payload_size = parse_request_header(self._buffer, self._start)
+            if payload_size > self.max_payload_size:
+                raise ValueError(f"Payload size {payload_size} exceeds limit of {self.max_payload_size} bytes")
+            frame_end = self._start + REQUEST_HEADER_SIZE + payload_size
+            if frame_end > self._end:
+                # Remember how much is missing so the next read makes room for all of it
+                self._wanted = frame_end - self._end
+                return
+            payload = self._view[self._start + REQUEST_HEADER_SIZE:frame_end]
+            self._start = frame_end
+            yield client_id, version, code, payload
+        self._wanted = 0
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self._buffer_size:
+                # Give back the memory a large frame needed; payload views handed out
+                # keep the old buffer alive as long as they are used
+                self._buffer = bytearray(self._buffer_size)
+                self._view = memoryview(self._buffer)
+
+    def _make_room(self, size):
+        """
+        Ensures at least size free bytes after the buffered data, first by moving the
+        unconsumed bytes to the front of the buffer and, if that is not enough, by
+        switching to a larger buffer.
+        """
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buffer):
+            # Allocate a new buffer rather than resizing, so payload views that were
+            # handed out earlier keep pointing at valid memory
+            new_size = max(len(self._buffer) * 2, pending + size)
+            buffer = bytearray(new_size)
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        elif pending:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start, self._end = 0, pending
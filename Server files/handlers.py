@@ -0,0 +1,306 @@
+import logging
+import binascii
+import time
+import uuid
+from dataBase import add_client, update_client_key, get_client_by_name, get_file
+from client_cache import client_cache, get_client_session
+from file_handler import (open_upload, abort_upload, process_file_content, mark_resume_point, resume_upload,
+                          discard_partial_upload, safe_filename)
+from download import FileStream
+from crypt import generate_aes_key, encrypt_aes_key, decrypt_cbc, open_chunk, chunk_nonce, CIPHER_CBC, CIPHER_NAMES
+from crypto_worker import Deferred, offload
+from scheduler import UploadLimitReached
+from file_compression import METHOD_NAMES, available_methods
+from metrics import REQUESTS, REQUEST_SECONDS, PARSE_SECONDS
+from log_pipeline import RATE_LIMITED
+from protocol import *
+
+
+class ClientInfo:
+    """
+    Describes a client in log messages. The username is taken from the session cache
+    when the message is formatted, so logging never queries the database.
+    """
+    __slots__ = ('client_id',)
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+
+    def __str__(self):
+        session = client_cache.peek(self.client_id)
+        username = session.name if session else "Unknown"
+        return f"Client ID: {binascii.hexlify(self.client_id).decode()} (Username: {username})"
+
+
+def get_client_info(client_id):
+    """
+    get client info for representing it in log messages
+    """
+    return ClientInfo(client_id)
+
+
+def crypto_failed(client_id, error):
+    """
+    Build the response for a request whose crypto job failed.
+    """
+    logging.error("Crypto operation failed for client %s: %s", client_id.hex(), error)
+    return create_general_error(client_id)
+
+
+def acknowledge_chunk(client_id, file_name, file_info, windowed):
+    """
+    Build the response to a file chunk that did not complete the transfer. Windowed
+    clients get a cumulative ack every ACK_INTERVAL chunks, and for every chunk while
+    later chunks are held back, so the client keeps sending without waiting.
+    """
+    if not windowed:
+        return create_message_accepted(client_id)
+    received = file_info['received_packets']
+    if received - file_info['acked_packets'] < ACK_INTERVAL and not file_info['pending']:
+        return b''
+    file_info['acked_packets'] = received
+    return create_chunks_acked(client_id, file_name, received)
+
+
+def handle_file_chunk(data, client_id, parsed_data, client_info, windowed=False):
+    """
+    Handle one 828 file chunk. The chunk is decrypted on the crypto stage when it is
+    large enough to be worth it, and written to disk once the plaintext is back.
+    Chunks of a CBC stream were ordered before; chunks sealed with another cipher
+    suite are opened as they arrive, in any order, and ordered once authenticated.
+    """
+    file_name = parsed_data['file_name']
+    file_info = data.file_data[file_name]
+    replaced = parsed_data['replaced']
+    if replaced is not None and 'upload' in replaced:
+        logging.info("%s sends %s anew with a different size, the earlier upload is discarded", client_info,
+                     file_name)
+        # Chunks of the earlier upload still on the crypto stage are dropped when they return
+        replaced['upload']['suspended'] = True
+        abort_upload(replaced['upload'])
+    if 'packet_number' in parsed_data:
+        logging.debug("Received file chunk %d/%d from %s", parsed_data['packet_number'], parsed_data['total_packets'],
+                      client_info, extra=RATE_LIMITED)
+    if 'upload' not in file_info:
+        session = get_client_session(client_id)
+        if session is None:
+            raise ValueError(f"File content from unknown client {client_id.hex()}")
+        if file_info['compression'] not in available_methods():
+            logging.warning("Rejected upload of %s: compression method %s is not supported", file_name,
+                            METHOD_NAMES.get(file_info['compression'], file_info['compression']))
+            data.file_data.pop(file_name, None)
+            return create_general_error(client_id)
+        if file_info['cipher'] not in CIPHER_NAMES:
+            logging.warning("Rejected upload of %s: cipher suite %s is not supported", file_name, file_info['cipher'])
+            data.file_data.pop(file_name, None)
+            return create_general_error(client_id)
+        # A transfer that was not resumed with an 829 request starts over
+        discard_partial_upload(client_id, file_name)
+        try:
+            file_info['upload'] = open_upload(client_id, file_name, session.aes_key, file_info['orig_file_size'],
+                                              file_info['compression'], file_info['cipher'])
+        except UploadLimitReached as e:
+            logging.warning("Rejected upload of %s: %s", file_name, e)
+            data.file_data.pop(file_name, None)
+            return create_general_error(client_id)
+    upload = file_info['upload']
+
+    def release(is_complete):
+        if is_complete or upload['file'] is None:
+            # Clear the file data once the transfer finished or failed
+            abort_upload(upload)
+            data.file_data.pop(file_name, None)
+
+    def write_chunk(plaintext, is_complete):
+        response = process_file_content(client_id, file_info, plaintext)
+        if response is None:
+            mark_resume_point(file_info)
+            response = acknowledge_chunk(client_id, file_name, file_info, windowed)
+        if is_complete:
+            logging.info("File transfer complete for %s from %s", file_name, client_info)
+        release(is_complete)
+        return response
+
+    def chunk_failed(error):
+        if upload['suspended']:
+            return b''
+        abort_upload(upload)
+        release(True)
+        return crypto_failed(client_id, error)
+
+    if upload['cipher'] != CIPHER_CBC:
+        packet_number = parsed_data['packet_number']
+
+        def chunk_opened(plaintext):
+            if upload['suspended']:
+                return b''  # The client disconnected, the upload was kept for resuming
+            try:
+                plaintext = order_chunk(file_info, packet_number, plaintext)
+                is_complete = transfer_complete(file_info)
+            except ValueError as e:
+                logging.warning("Rejected upload of %s: %s", file_name, e)
+                abort_upload(upload)
+                release(True)
+                return create_general_error(client_id)
+            return write_chunk(plaintext, is_complete)
+
+        if not parsed_data['wanted']:
+            return acknowledge_chunk(client_id, file_name, file_info, windowed)
+        # The receive buffer is reused once the request was handled, the worker gets a copy
+        sealed = bytes(parsed_data['content'])
+        return offload(open_chunk, (upload['key'], chunk_nonce(parsed_data['transfer_nonce'], packet_number),
+                                    parsed_data['associated_data'], sealed),
+                       chunk_opened, chunk_failed, size=len(sealed))
+
+    is_complete = parsed_data['is_complete']
+    iv, ciphertext = upload['decryptor'].split(parsed_data['content'], final=is_complete)
+
+    def chunk_decrypted(plaintext):
+        if upload['suspended']:
+            return b''  # The client disconnected, the upload was kept for resuming
+        return write_chunk(plaintext, is_complete)
+
+    if not ciphertext:
+        return chunk_decrypted(b'')
+    return offload(decrypt_cbc, (upload['key'], iv, ciphertext, is_complete),
+                   chunk_decrypted, chunk_failed, size=len(ciphertext))
+
+
+def handle_upload_status(data, client_id, file_name):
+    """
+    Handle an 829 upload status request. An interrupted upload is restored on this
+    connection, and the client is told which chunks the server already has.
+    """
+    file_info = data.file_data.get(file_name)
+    if file_info is None:
+        session = get_client_session(client_id)
+        if session is None:
+            logging.warning("Upload status request from unknown client %s", client_id.hex())
+            return create_general_error(client_id)
+        try:
+            file_info = resume_upload(client_id, file_name, session.aes_key)
+        except UploadLimitReached as e:
+            logging.warning("Rejected resuming the upload of %s: %s", file_name, e)
+            return create_general_error(client_id)
+        if file_info is None:
+            return create_upload_status(client_id, file_name, 0, b'')
+        data.file_data[file_name] = file_info
+    total_packets = file_info['total_packets']
+    # Chunks held back for reordering count as received, they need not be sent again
+    bitmap = chunk_bitmap(total_packets, file_info['received_packets'], file_info['pending'])
+    return create_upload_status(client_id, file_name, total_packets, bitmap)
+
+
+def handle_download(client_id, file_name, offset, length):
+    """
+    Handle an 830 download request for a file the client stored. Returns a FileStream
+    that produces the 1610 responses, or an error response if there is no such file
+    or the range starts past its end.
+    """
+    session = get_client_session(client_id)
+    if session is None:
+        logging.warning("Download request from unknown client %s", client_id.hex())
+        return create_general_error(client_id)
+    stored_name = safe_filename(file_name)
+    row = get_file(client_id, stored_name)
+    if row is None:
+        logging.warning("Download of %s requested by %s, which has no such file", file_name, client_id.hex())
+        return create_general_error(client_id)
+    try:
+        return FileStream(client_id, stored_name, row[2], session.aes_key, offset, length)
+    except (OSError, ValueError) as e:
+        logging.warning("Cannot send %s to %s: %s", file_name, client_id.hex(), e)
+        return create_general_error(client_id)
+
+
+def process_request(data, client_id, version, code, payload):
+    """
+    Process a single complete request from a client and return the response bytes,
+    a Deferred when the response waits for a job on the crypto stage, or a FileStream
+    whose responses are produced as the connection's output drains.
+    The payload may be a memoryview into the connection's receive buffer.
+    """
+    start = time.perf_counter()
+    # Codes are labelled as sent only if known, so clients cannot add label values
+    code_label = code if code in REQUEST_CODES else 'other'
+    REQUESTS.labels(code_label).inc()
+    windowed = version >= WINDOWED_VERSION
+    parsed_data = parse_request_payload(code, payload, data.file_data, windowed, version >= COMPRESSED_VERSION,
+                                        version >= SEALED_VERSION)
+    PARSE_SECONDS.time_since(start)
+    client_info = get_client_info(client_id)
+
+    # Handle different types of requests based on the code
+    if code == 825:  # Client registration
+        logging.info("Received client registration request from %s", client_info)
+        if get_client_by_name(parsed_data['name']):
+            logging.warning("Registration failed: Username %s already exists", parsed_data['name'])
+            response = create_registration_failed()
+        else:
+            new_client_id = uuid.uuid4().bytes
+            aes_key = generate_aes_key()
+            if add_client(new_client_id, parsed_data['name'], aes_key):
+                logging.info("%s registered successfully", client_info)
+                response = create_registration_success(new_client_id)
+            else:
+                # Another connection registered the same name in the meantime
+                logging.warning("Registration failed: Username %s already exists", parsed_data['name'])
+                response = create_registration_failed()
+    elif code == 826:  # Public key update
+        logging.info("Received public key update from %s", client_info)
+        session = get_client_session(client_id)
+        if session:
+            update_client_key(client_id, parsed_data['public_key'])
+
+            def key_accepted(encrypted_aes_key):
+                logging.info("Public key updated for %s. Sending encrypted AES key.", client_info)
+                return create_public_key_accepted(client_id, encrypted_aes_key)
+
+            response = offload(encrypt_aes_key, (session.aes_key, parsed_data['public_key']),
+                               key_accepted, lambda e: crypto_failed(client_id, e))
+        else:
+            logging.warning("Public key update from unknown client %s", client_id.hex())
+            response = create_general_error(client_id)
+    elif code == 827:  # Reconnect
+        session = get_client_session(client_id)
+        # Check if client exists, name matches and a public key is on record
+        if session and session.name == parsed_data['name'] and session.public_key:
+            logging.info("Received reconnection request from %s", client_info)
+
+            def reconnected(encrypted_aes_key):
+                logging.info("%s reconnected successfully", client_info)
+                return create_reconnect_confirm(client_id, encrypted_aes_key)
+
+            # Encrypt with stored public key
+            response = offload(encrypt_aes_key, (session.aes_key, session.public_key),
+                               reconnected, lambda e: crypto_failed(client_id, e))
+        else:
+            logging.warning("Reconnection failed for client %s", client_id.hex())
+            response = create_reconnect_denied(client_id)
+    elif code == 828:  # File content
+        response = handle_file_chunk(data, client_id, parsed_data, client_info, windowed)
+    elif code == 829:  # Upload status
+        logging.info("Received upload status request for %s from %s", parsed_data['file_name'], client_info)
+        response = handle_upload_status(data, client_id, parsed_data['file_name'])
+    elif code == 830:  # File download
+        logging.info("Received download request for %s from %s", parsed_data['file_name'], client_info)
+        response = handle_download(client_id, parsed_data['file_name'], parsed_data['offset'], parsed_data['length'])
+    elif code == 900:  # CRC correct
+        logging.info("CRC correct for file from client %s", client_info)
+        response = create_message_accepted(client_id)
+    elif code == 901:  # CRC incorrect, client will retry
+        logging.info("CRC incorrect for file from client %s, client will retry", client_info)
+        response = create_message_accepted(client_id)
+    elif code == 902:  # CRC incorrect, final failure
+        logging.warning("File transfer failed after multiple attempts for client %s", client_info)
+        response = create_message_accepted(client_id)
+    else:
+        logging.warning("Unknown command %s from client %s", code, client_id.hex())
+        response = create_general_error(client_id)
+
+    latency = REQUEST_SECONDS.labels(code_label)
+    if isinstance(response, Deferred):
+        response.future.add_done_callback(lambda future: latency.time_since(start))
+    else:
+        latency.time_since(start)
+    return response
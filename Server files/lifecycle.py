@@ -0,0 +1,144 @@
+import math
+import time
+
+TICK = 1.0  # Seconds per slot of the timer wheel
+WHEEL_SLOTS = 512  # Slots of the timer wheel; longer delays take several rounds
+IDLE_TIMEOUT = 300.0  # Seconds a connection may go without sending or receiving anything
+HEADER_TIMEOUT = 30.0  # Seconds a client may take to complete a request header it started
+TRANSFER_TIMEOUT = 600.0  # Seconds an upload may go without a chunk being accepted
+MAX_TRANSFER_TIME = None  # Seconds an upload may take on one connection; None for no limit
+MAX_CONNECTIONS = 1024  # Open client connections; further ones are refused
+STALE_UPLOAD_SWEEP_INTERVAL = 3600.0  # Seconds between two sweeps for abandoned partial uploads
+
+
+class Timer:
+    """
+    A callback scheduled on a TimerWheel.
+    """
+    __slots__ = ('callback', 'rounds', 'slot', 'wheel')
+
+    def __init__(self, callback, rounds, slot, wheel):
+        self.callback = callback
+        self.rounds = rounds
+        self.slot = slot
+        self.wheel = wheel
+
+    def cancel(self):
+        """
+        Removes the timer from its wheel, if it has not fired yet.
+        """
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+
+class TimerWheel:
+    """
+    A hashed timer wheel: timers are kept in the slot of the tick they expire in, so
+    scheduling and cancelling are O(1) and advancing only looks at the current slot.
+    Timers fire at most one tick late. Not thread safe, it belongs to the event loop.
+    """
+
+    def __init__(self, tick=TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._position = 0  # Slot that fires at _next_tick
+        self._next_tick = time.monotonic() + tick
+        self.count = 0  # Timers scheduled and not fired or cancelled yet
+
+    def schedule(self, delay, callback):
+        """
+        Calls callback() after delay seconds and returns the Timer.
+        """
+        ticks = max(0, math.ceil((time.monotonic() + delay - self._next_tick) / self.tick))
+        rounds, offset = divmod(ticks, len(self._slots))
+        slot = self._slots[(self._position + offset) % len(self._slots)]
+        timer = Timer(callback, rounds, slot, self)
+        slot.add(timer)
+        self.count += 1
+        return timer
+
+    def advance(self, now=None):
+        """
+        Fires the timers of every tick that passed.
+        """
+        now = time.monotonic() if now is None else now
+        while now >= self._next_tick:
+            if not self.count:
+                # Nothing scheduled, skip the idle ticks instead of walking through them
+                self._next_tick = now + self.tick
+                return
+            slot = self._slots[self._position]
+            self._position = (self._position + 1) % len(self._slots)
+            self._next_tick += self.tick
+            for timer in list(slot):
+                if timer.rounds:
+                    timer.rounds -= 1
+                    continue
+                slot.discard(timer)
+                timer.slot = None
+                self.count -= 1
+                timer.callback()
+
+    def timeout(self, now=None):
+        """
+        Returns the seconds until the next tick, or None when no timer is scheduled.
+        """
+        if not self.count:
+            return None
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._next_tick - now)
+
+
+def connection_deadline(data, now, reading):
+    """
+    Checks a connection against the idle, header and transfer timeouts. Returns the
+    reason it expired, or None and the time of its next deadline. The header deadline
+    only runs while the server reads from the connection, so a client is never
+    blamed for requests the server holds back. The transfer deadline moves with every
+    accepted chunk, so a large upload that keeps making progress is never cut off
+    unless MAX_TRANSFER_TIME is set.
+    """
+    deadline = data.last_activity + IDLE_TIMEOUT
+    if now >= deadline:
+        return f"idle for {IDLE_TIMEOUT:.0f} seconds", None
+    if reading and data.header_started is not None:
+        header_deadline = data.header_started + HEADER_TIMEOUT
+        if now >= header_deadline:
+            return f"request header not completed within {HEADER_TIMEOUT:.0f} seconds", None
+        deadline = min(deadline, header_deadline)
+    for file_name, file_info in data.file_data.items():
+        transfer_deadline = file_info['last_progress'] + TRANSFER_TIMEOUT
+        if now >= transfer_deadline:
+            return f"upload of {file_name} made no progress for {TRANSFER_TIMEOUT:.0f} seconds", None
+        deadline = min(deadline, transfer_deadline)
+        if MAX_TRANSFER_TIME is not None:
+            transfer_deadline = file_info['started'] + MAX_TRANSFER_TIME
+            if now >= transfer_deadline:
+                return f"upload of {file_name} not completed within {MAX_TRANSFER_TIME:.0f} seconds", None
+            deadline = min(deadline, transfer_deadline)
+    return None, deadline
+
+
+def at_connection_limit(count):
+    """
+    Tells whether count open connections are as many as the server accepts.
+    """
+    return count >= MAX_CONNECTIONS
+
+
+def configure_lifecycle(idle_timeout=IDLE_TIMEOUT, header_timeout=HEADER_TIMEOUT,
+                        transfer_timeout=TRANSFER_TIMEOUT, max_connections=MAX_CONNECTIONS,
+                        max_transfer_time=MAX_TRANSFER_TIME):
+    """
+    Sets the connection timeouts in seconds and the connection limit. A
+    max_transfer_time of None lets uploads take as long as they keep progressing.
+    """
+    global IDLE_TIMEOUT, HEADER_TIMEOUT, TRANSFER_TIMEOUT, MAX_CONNECTIONS, MAX_TRANSFER_TIME
+    for name, value in (('idle', idle_timeout), ('header', header_timeout), ('transfer', transfer_timeout),
+                        ('connection limit', max_connections), ('transfer time', max_transfer_time)):
+        if value is not None and value <= 0:
+            raise ValueError(f"The {name} setting must be positive, got {value}")
+    IDLE_TIMEOUT, HEADER_TIMEOUT, TRANSFER_TIMEOUT = idle_timeout, header_timeout, transfer_timeout
+    MAX_CONNECTIONS, MAX_TRANSFER_TIME = max_connections, max_transfer_time
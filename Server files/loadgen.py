@@ -0,0 +1,533 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from Crypto.PublicKey import RSA
+from crypt import (encrypt_aes, decrypt_aes_key, seal_chunk, open_chunk, chunk_nonce, CIPHER_CBC, CIPHER_NAMES,
+                   GCM_TAG_SIZE, TRANSFER_NONCE_SIZE)
+from crc import CHECKSUMS, configure_checksum, checksum_update, checksum_final
+from file_compression import METHOD_NAMES, compress
+from protocol import (REQUEST_HEADER, PROTOCOL_VERSION, WINDOWED_VERSION, COMPRESSED_VERSION, SEALED_VERSION,
+                      ACK_INTERVAL)
+
+RESPONSE_HEADER = struct.Struct('<BHI')  # Version, code, payload size
+DEFAULT_CHUNK_SIZE = 1024  # MAX_PACKET_SIZE of the C++ client
+DEFAULT_WINDOW = 32  # WINDOW_SIZE of the C++ client
+RSA_EXPONENT = 17  # Crypto++ default, gives the 160 byte public key field of the 826 request
+SERVER_START_TIMEOUT = 10.0  # Seconds to wait for a local server to accept connections
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the server answers with an unexpected response code.
+    """
+
+
+class Stats:
+    """
+    Latencies per request code and transfer totals, shared by all simulated clients.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = 0
+        self.files = 0
+        self.file_bytes = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+    def record(self, code, seconds):
+        with self._lock:
+            self.latencies.setdefault(code, []).append(seconds)
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value below which the given fraction of sorted_values lies.
+    """
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def parse_distribution(spec):
+    """
+    Parses a file size distribution and returns a function drawing sizes in bytes:
+    'fixed:SIZE', 'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA'.
+    """
+    kind, *params = spec.split(':')
+    try:
+        if kind == 'fixed' and len(params) == 1:
+            size = int(params[0])
+            return lambda rng: size
+        if kind == 'uniform' and len(params) == 2:
+            low, high = int(params[0]), int(params[1])
+            return lambda rng: rng.randint(low, high)
+        if kind == 'lognormal' and len(params) == 2:
+            median, sigma = float(params[0]), float(params[1])
+            return lambda rng: max(1, int(median * rng.lognormvariate(0, sigma)))
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"Invalid size distribution {spec}, expected fixed:SIZE, "
+                                     "uniform:MIN:MAX or lognormal:MEDIAN:SIGMA")
+
+
+def parse_compression(spec):
+    """
+    Parses a compression option of the form METHOD or METHOD:LEVEL and returns the
+    method number and level.
+    """
+    name, _, level = spec.partition(':')
+    methods = {method_name: method for method, method_name in METHOD_NAMES.items()}
+    if name not in methods or (level and not level.isdigit()):
+        raise argparse.ArgumentTypeError(f"Invalid compression {spec}, expected one of "
+                                         f"{', '.join(methods)} with an optional :LEVEL")
+    return methods[name], int(level) if level else None
+
+
+def name_field(name):
+    """
+    Encodes a username or file name as the null padded 255 byte field of the protocol.
+    """
+    return name.encode('ascii').ljust(255, b'\0')
+
+
+class SimulatedClient:
+    """
+    One client speaking the protocol like the C++ client: it registers (825), sends
+    its public key (826), reconnects (827) and uploads files in chunks (828) that
+    are confirmed with a CRC request (900).
+    """
+
+    def __init__(self, host, port, name, stats, chunk_size=DEFAULT_CHUNK_SIZE, window=0, compression=(0, None),
+                 cipher=CIPHER_CBC):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.stats = stats
+        self.chunk_size = chunk_size
+        self.window = window
+        self.compression, self.compression_level = compression
+        self.cipher = cipher
+        # Version of windowed 828 requests, the lowest one that carries what the chunks need
+        if cipher != CIPHER_CBC:
+            self.chunk_version = SEALED_VERSION
+        else:
+            self.chunk_version = COMPRESSED_VERSION if self.compression else WINDOWED_VERSION
+        self.client_id = bytes(16)
+        self.aes_key = None
+        self.rsa_key = RSA.generate(1024, e=RSA_EXPONENT)
+        self.sock = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def send(self, code, payload, version=PROTOCOL_VERSION):
+        request = REQUEST_HEADER.pack(self.client_id, version, code, len(payload)) + payload
+        self.sock.sendall(request)
+        self.stats.add(bytes_sent=len(request))
+
+    def _recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def receive(self, *expected):
+        """
+        Reads one response and returns its code and payload. Raises ProtocolError if
+        the code is not one of expected.
+        """
+        _, code, size = RESPONSE_HEADER.unpack(self._recv_exactly(RESPONSE_HEADER.size))
+        payload = self._recv_exactly(size)
+        self.stats.add(bytes_received=RESPONSE_HEADER.size + size)
+        if code not in expected:
+            raise ProtocolError(f"Expected response {expected}, got {code}")
+        return code, payload
+
+    def request(self, code, payload, *expected):
+        """
+        Sends a request, waits for its response and records the round trip time.
+        """
+        start = time.perf_counter()
+        self.send(code, payload)
+        response = self.receive(*expected)
+        self.stats.record(code, time.perf_counter() - start)
+        return response
+
+    def register(self):
+        _, payload = self.request(825, name_field(self.name), 1600)
+        self.client_id = payload[:16]
+
+    def exchange_keys(self):
+        public_key = self.rsa_key.publickey().export_key('DER')
+        _, payload = self.request(826, name_field(self.name) + public_key, 1602)
+        self.aes_key = decrypt_aes_key(payload[16:], self.rsa_key.export_key('DER'))
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+        _, payload = self.request(827, name_field(self.name), 1605)
+        self.aes_key = decrypt_aes_key(payload[16:], self.rsa_key.export_key('DER'))
+
+    def send_file(self, file_name, content):
+        """
+        Uploads content and confirms its checksum. Returns False if the checksum
+        reported by the server does not match; sealed uploads are authenticated
+        chunk by chunk and get no checksum.
+        """
+        data = compress(content, self.compression, self.compression_level) if self.compression else content
+        file_name_bytes = name_field(file_name)
+        if self.cipher != CIPHER_CBC:
+            chunk, total_packets = self._sealed_chunks(data, len(content), file_name_bytes)
+        else:
+            chunk, total_packets = self._cbc_chunks(data, len(content), file_name_bytes)
+        self.request(829, file_name_bytes, 1609)
+
+        if self.window:
+            payload = self._send_windowed(chunk, total_packets)
+        else:
+            for packet_number in range(1, total_packets):
+                self.request(828, chunk(packet_number), 1604)
+            _, payload = self.request(828, chunk(total_packets), 1603)
+        expected = checksum_final(checksum_update(content), len(content))
+        crc, = struct.unpack('<I', payload[16 + 4 + 255:16 + 4 + 255 + 4])
+        self.request(900, file_name_bytes + struct.pack('<I', expected), 1604)
+        self.stats.add(files=1, file_bytes=len(content))
+        return crc == expected or self.cipher != CIPHER_CBC
+
+    def _check_packets(self, total_packets, size):
+        if total_packets > 0xFFFF:
+            raise ValueError(f"{size} bytes need more than 65535 chunks of {self.chunk_size} bytes")
+
+    def _cbc_chunks(self, data, size, file_name_bytes):
+        """
+        Encrypts data as one CBC stream cut into chunks. Returns a function building
+        the payload of a chunk from its packet number, and the number of chunks.
+        """
+        encrypted = encrypt_aes(data, self.aes_key)
+        total_packets = (len(encrypted) + self.chunk_size - 1) // self.chunk_size
+        self._check_packets(total_packets, size)
+        prefix = struct.pack('<II', len(encrypted), size)
+        method = bytes([self.compression]) if self.compression else b''
+
+        def chunk(packet_number):
+            offset = (packet_number - 1) * self.chunk_size
+            return (prefix + struct.pack('<HH', packet_number, total_packets) + file_name_bytes + method
+                    + encrypted[offset:offset + self.chunk_size])
+
+        return chunk, total_packets
+
+    def _sealed_chunks(self, data, size, file_name_bytes):
+        """
+        Seals data chunk by chunk with a fresh transfer nonce, each chunk holding
+        chunk_size bytes with its tag. Returns the same as _cbc_chunks.
+        """
+        plain_size = self.chunk_size - GCM_TAG_SIZE
+        total_packets = max(1, (len(data) + plain_size - 1) // plain_size)
+        self._check_packets(total_packets, size)
+        transfer_nonce = os.urandom(TRANSFER_NONCE_SIZE)
+        # The header of every chunk is authenticated except for the packet number, which is in the nonce
+        prefix = struct.pack('<II', len(data) + total_packets * GCM_TAG_SIZE, size)
+        suffix = (struct.pack('<H', total_packets) + file_name_bytes + bytes([self.compression, self.cipher])
+                  + transfer_nonce)
+        sealed = [seal_chunk(data[offset:offset + plain_size], self.aes_key,
+                             chunk_nonce(transfer_nonce, packet_number), prefix + suffix)
+                  for packet_number, offset in enumerate(range(0, total_packets * plain_size, plain_size), 1)]
+
+        def chunk(packet_number):
+            return prefix + struct.pack('<H', packet_number) + suffix + sealed[packet_number - 1]
+
+        return chunk, total_packets
+
+    def download_file(self, file_name, offset=0, length=0):
+        """
+        Downloads a stored file, or length bytes of it from offset, checking the tag
+        of every chunk. The latency runs until the last chunk arrived.
+        """
+        start = time.perf_counter()
+        self.send(830, name_field(file_name) + struct.pack('<II', offset, length))
+        content = []
+        while True:
+            _, payload = self.receive(1610)
+            prefix_size = 16 + 255 + 12 + TRANSFER_NONCE_SIZE
+            _, chunk_offset, packet_number, total_packets = struct.unpack('<IIHH', payload[16 + 255:16 + 255 + 12])
+            nonce = chunk_nonce(payload[16 + 255 + 12:prefix_size], packet_number)
+            content.append(open_chunk(self.aes_key, nonce, payload[:prefix_size], payload[prefix_size:]))
+            if packet_number == total_packets:
+                break
+        self.stats.record(830, time.perf_counter() - start)
+        return b''.join(content)
+
+    def _send_windowed(self, chunk, total_packets):
+        """
+        Sends the chunks of a file with up to window chunks in flight. The latency of
+        a chunk runs until the cumulative ack that covers it. Returns the payload of
+        the file accepted response.
+        """
+        sent_at = {}
+        acked = 0
+        next_packet = 1
+        while True:
+            while next_packet <= total_packets and next_packet - acked <= self.window:
+                sent_at[next_packet] = time.perf_counter()
+                self.send(828, chunk(next_packet), self.chunk_version)
+                next_packet += 1
+            code, payload = self.receive(1608, 1603)
+            now = time.perf_counter()
+            if code == 1603:
+                for start in sent_at.values():
+                    self.stats.record(828, now - start)
+                return payload
+            packet_number, = struct.unpack('<H', payload[16 + 255:16 + 255 + 2])
+            for number in range(acked + 1, packet_number + 1):
+                self.stats.record(828, now - sent_at.pop(number))
+            acked = max(acked, packet_number)
+
+
+def make_content(rng, size, kind):
+    """
+    Returns size bytes of file content: random bytes, which do not compress, or CSV
+    text resembling the logs most uploads consist of.
+    """
+    if kind == 'random':
+        return rng.randbytes(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = (f"2026-01-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d},"
+                f"{rng.choice(('INFO', 'INFO', 'INFO', 'WARNING', 'ERROR'))},worker-{rng.randint(1, 16)},"
+                f"request {rng.randint(1, 10 ** 6)} took {rng.random() * 100:.3f} ms\n")
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def run_client(index, args, stats, run_id, barrier):
+    """
+    Body of one simulated client thread. The RSA key is generated before the barrier
+    so key generation does not count towards the measured time.
+    """
+    rng = random.Random(f"{args.seed}-{index}" if args.seed is not None else None)
+    draw_size = args.file_size
+    client = SimulatedClient(args.host, args.port, f"loadgen-{run_id}-{index}", stats,
+                             args.chunk_size, args.window, args.compression, args.cipher)
+    barrier.wait()
+    try:
+        client.connect()
+        client.register()
+        client.exchange_keys()
+        for number in range(args.files):
+            if args.think_time:
+                time.sleep(rng.expovariate(1 / args.think_time))
+            if number and rng.random() < args.reconnect:
+                client.reconnect()
+            content = make_content(rng, draw_size(rng), args.content)
+            if not client.send_file(f"load_{number}.bin", content):
+                logging.warning("Checksum mismatch for file %d of client %d", number, index)
+                stats.add(errors=1)
+            if args.download and client.download_file(f"load_{number}.bin") != content:
+                logging.warning("Downloaded file %d of client %d differs from the upload", number, index)
+                stats.add(errors=1)
+    except (OSError, ProtocolError, ValueError) as e:
+        logging.error("Client %d failed: %s", index, e)
+        stats.add(errors=1)
+    finally:
+        client.close()
+
+
+def read_rss(pid):
+    """
+    Returns the current and peak resident set size of a process in bytes, or None
+    where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) * 1024, int(fields['VmHWM'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _run_local_server(workdir, port, engine, checksum):
+    """
+    Entry point of the local server process. The server keeps its database and
+    uploads in workdir.
+    """
+    os.chdir(workdir)
+    os.makedirs('uploads', exist_ok=True)
+    logging.disable(logging.INFO)
+    import mainServer
+    from crypto_worker import configure_stage
+    mainServer.PORT = port
+    configure_stage()
+    configure_checksum(checksum)
+    if engine == 'asyncio':
+        from async_server import start_async_server
+        start_async_server(mainServer.HOST, port)
+    else:
+        mainServer.start_server()
+
+
+def start_local_server(workdir, port, engine='selectors', checksum='crc32'):
+    """
+    Starts a server on 127.0.0.1:port in a child process and waits until it accepts
+    connections. Returns the process.
+    """
+    process = multiprocessing.Process(target=_run_local_server, args=(workdir, port, engine, checksum),
+                                      name='loadgen-server', daemon=True)
+    process.start()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1.0).close()
+            return process
+        except OSError:
+            if not process.is_alive() or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError("Local server did not start")
+            time.sleep(0.05)
+
+
+def free_port():
+    """
+    Returns a TCP port on 127.0.0.1 that is free right now.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def report(stats, elapsed, rss):
+    """
+    Prints throughput, latency percentiles per request code and the server RSS.
+    """
+    requests = sum(len(values) for values in stats.latencies.values())
+    print(f"{stats.files} files, {stats.file_bytes / 1e6:.1f} MB in {elapsed:.2f} s, {stats.errors} errors")
+    print(f"throughput: {stats.file_bytes / elapsed / 1e6:.2f} MB/s of file content, "
+          f"{requests / elapsed:.0f} requests/s")
+    print(f"wire: {stats.bytes_sent / 1e6:.1f} MB sent, {stats.bytes_received / 1e6:.1f} MB received")
+    print(f"{'code':>6} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for code in sorted(stats.latencies):
+        values = sorted(stats.latencies[code])
+        print(f"{code:>6} {len(values):>8} {percentile(values, 0.5) * 1e3:>9.3f} "
+              f"{percentile(values, 0.99) * 1e3:>9.3f} {values[-1] * 1e3:>9.3f}")
+    if rss is not None:
+        print(f"server RSS: {rss[0] / 1e6:.1f} MB, peak {rss[1] / 1e6:.1f} MB")
+
+
+def parse_args():
+    """
+    Parse the load generator options.
+    """
+    parser = argparse.ArgumentParser(description="Load generator for the secure file transfer server")
+    parser.add_argument('--local', action='store_true',
+                        help="start a server in a temporary directory on a free local port and load it")
+    parser.add_argument('--engine', choices=['selectors', 'asyncio'], default='selectors',
+                        help="engine of the local server (default: selectors)")
+    parser.add_argument('--host', default='127.0.0.1', help="server address (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=1256, help="server port (default: 1256)")
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help="process ID of a running server, to report its RSS")
+    parser.add_argument('--clients', type=int, default=10, help="concurrent clients (default: 10)")
+    parser.add_argument('--files', type=int, default=5, help="files uploaded per client (default: 5)")
+    parser.add_argument('--file-size', type=parse_distribution, default='lognormal:65536:1.0',
+                        help="file size distribution: fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA "
+                             "(default: lognormal:65536:1.0)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"encrypted bytes per 828 chunk (default: {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW,
+                        help=f"chunks in flight per upload, 0 waits for every chunk's ack (default: {DEFAULT_WINDOW})")
+    parser.add_argument('--content', choices=['random', 'text'], default='random',
+                        help="random bytes or compressible CSV text as file content (default: random)")
+    parser.add_argument('--compression', type=parse_compression, default='none',
+                        help="compress uploads before encrypting them: none, zlib, lzma or zstd, "
+                             "optionally with a level, e.g. zlib:9 (default: none)")
+    parser.add_argument('--cipher', choices=list(CIPHER_NAMES.values()), default=CIPHER_NAMES[CIPHER_CBC],
+                        help="cipher suite of uploads: one aes-cbc stream, or aes-gcm sealing every chunk "
+                             "(default: aes-cbc)")
+    parser.add_argument('--download', action='store_true',
+                        help="download every file (830) after uploading it and compare the content")
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help="mean seconds a client waits before each upload (default: 0)")
+    parser.add_argument('--reconnect', type=float, default=0.0,
+                        help="probability that a client reconnects (827) before an upload (default: 0)")
+    parser.add_argument('--checksum', choices=CHECKSUMS, default='crc32',
+                        help="checksum the server is configured with (default: crc32)")
+    parser.add_argument('--seed', default=None, help="seed for file sizes and contents")
+    args = parser.parse_args()
+    if args.window and args.window < ACK_INTERVAL:
+        parser.error(f"--window must be 0 or at least the server's ack interval ({ACK_INTERVAL})")
+    if args.compression[0] and not args.window:
+        parser.error("--compression needs windowed transfers, --window must not be 0")
+    args.cipher = {name: cipher for cipher, name in CIPHER_NAMES.items()}[args.cipher]
+    if args.cipher != CIPHER_CBC and not args.window:
+        parser.error("--cipher aes-gcm needs windowed transfers, --window must not be 0")
+    if args.cipher != CIPHER_CBC and args.chunk_size <= GCM_TAG_SIZE:
+        parser.error(f"--chunk-size must be larger than {GCM_TAG_SIZE}")
+    return args
+
+
+def main():
+    """
+    Run the simulated clients against a server and report the results.
+    """
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    configure_checksum(args.checksum)
+    run_id = uuid.uuid4().hex[:8]  # Keeps usernames unique across runs against the same server
+    server = None
+    workdir = None
+    server_pid = args.server_pid
+    if args.local:
+        workdir = tempfile.TemporaryDirectory(prefix='loadgen-')
+        args.host, args.port = '127.0.0.1', free_port()
+        server = start_local_server(workdir.name, args.port, args.engine, args.checksum)
+        server_pid = server.pid
+
+    stats = Stats()
+    barrier = threading.Barrier(args.clients + 1)
+    threads = [threading.Thread(target=run_client, args=(index, args, stats, run_id, barrier),
+                                name=f"loadgen-{index}") for index in range(args.clients)]
+    try:
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        report(stats, elapsed, read_rss(server_pid) if server_pid else None)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        if workdir is not None:
+            workdir.cleanup()
+    if stats.errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_QUEUE_SIZE = 10000  # Records waiting for the writer thread before new ones are dropped
+RATE_LIMIT_INTERVAL = 1.0  # Seconds over which records of one message are counted
+RATE_LIMIT_BURST = 20  # Records of one rate limited message passed per interval
+RATE_LIMIT_EXPIRY = 60.0  # Seconds after which the window of a message that is not logged any more is dropped
+LOG_FORMATS = ('json', 'text')
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Attributes every LogRecord has; anything else was passed in extra and is logged as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'rate_limit'}
+# Passed as extra by messages logged for every chunk, so RateLimitFilter limits them
+RATE_LIMITED = {'rate_limit': True}
+
+_listener = None
+_listener_pid = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one JSON object per line. Values passed with extra become
+    fields of their own.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most burst records of the same message template per interval, so a
+    message logged for every chunk cannot flood the log. Only records logged with
+    extra=RATE_LIMITED below WARNING are limited; everything else always passes.
+    The first record passed after others were dropped carries their number in its
+    suppressed field. Windows of templates that were not logged for expiry seconds
+    are dropped, with the count of records they suppressed.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, burst=RATE_LIMIT_BURST, expiry=RATE_LIMIT_EXPIRY):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.expiry = max(expiry, interval)
+        self._windows = {}  # Message template -> [window start, passed, suppressed]
+        self._next_expiry = time.monotonic() + self.expiry
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, 'rate_limit', False):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_expiry:
+                self._windows = {msg: window for msg, window in self._windows.items()
+                                 if now - window[0] < self.expiry}
+                self._next_expiry = now + self.expiry
+            window = self._windows.get(record.msg)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[record.msg] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the writer thread without ever waiting. Records are formatted
+    on the writer thread, so log arguments must not be changed after the call.
+    When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    """
+    A stream handler that leaves flushing to the listener, which flushes once the
+    queue is drained instead of after every record.
+    """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchQueueListener(QueueListener):
+    """
+    Writes queued records on a background thread and flushes its handlers whenever
+    the queue runs empty, so a burst of records costs a single flush.
+    """
+
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+
+def setup_logging(level=logging.INFO, log_format='json', stream=None):
+    """
+    Routes all logging through a bounded queue to a writer thread, so logging calls
+    on the event loop never block on the output stream. Can be called again, also
+    in a forked worker process, to restart the pipeline with new settings.
+    """
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    # A listener inherited through fork has no thread in this process, it is simply dropped
+
+    output = BatchStreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    _listener = BatchQueueListener(log_queue, output)
+    _listener_pid = os.getpid()
+    _listener.start()
+    return handler
+
+
+def stop_logging():
+    """
+    Writes out the records still queued and stops the writer thread.
+    """
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+
+atexit.register(stop_logging)
@@ -1,22 +1,40 @@
 import selectors
 import socket
 import logging
-import binascii
+import argparse
+import heapq
+import itertools
 import os
-import uuid
+import time
 import types
-from dataBase import setup_database, get_client, add_client, update_client_key, get_client_aes_key, get_client_by_name
-from file_handler import process_file_content, calculate_crc
-from crypt import generate_aes_key, encrypt_aes_key, decrypt_aes
-from protocol import *
+from collections import deque
+from dataBase import setup_database, close_database, configure_database
+from client_cache import client_cache
+from file_handler import suspend_uploads, discard_stale_uploads, collect_blobs
+from framing import FrameDecoder
+from output_queue import OutputQueue
+from handlers import process_request
+from crypto_worker import Deferred, configure_stage, get_stage, DEFAULT_MAX_PENDING
+from download import FileStream
+from capture import start_capture, get_capture
+from crc import CHECKSUMS, configure_checksum
+from scheduler import (QUOTAS_FILE, TURN_QUANTUM, ANONYMOUS_CLIENT, load_quotas, get_limits, charge,
+                       default_max_buffered)
+from lifecycle import (TimerWheel, connection_deadline, at_connection_limit, configure_lifecycle, IDLE_TIMEOUT,
+                       HEADER_TIMEOUT, TRANSFER_TIMEOUT, MAX_CONNECTIONS, MAX_TRANSFER_TIME,
+                       STALE_UPLOAD_SWEEP_INTERVAL)
+from protocol import REQUEST_HEADER_SIZE, create_general_error
+from log_pipeline import LOG_FORMATS, setup_logging
+from metrics import (BYTES_RECEIVED, BYTES_SENT, SEND_SECONDS, ACTIVE_CONNECTIONS, LOOP_LAG_SECONDS,
+                     start_metrics_server)
 
 # Constants for server configuration
 HOST = '127.0.0.1'
 DEFAULT_PORT = 1256
 DATABASE_NAME = 'defensive.db'
 
-# Set up logging configuration
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Set up logging configuration; records are written by a background thread
+setup_logging()
 
 
 def read_port():
@@ -37,16 +55,332 @@ def read_port():
 PORT = read_port()
 # Initialize the selector for non-blocking I/O
 selector = selectors.DefaultSelector()
-file_data = {}
+# Selector data of the socket that wakes the loop when crypto jobs finish
+WAKEUP = 'wakeup'
+wakeup_sockets = None
+# Connections whose deferred response is ready, filled from crypto worker threads
+completed = deque()
+# Connections holding buffered requests until the crypto stage has room again
+stalled = deque()
+# Connections that used their share of a loop turn, served round-robin
+turns = deque()
+# Connections paused for their client's bandwidth, as (resume time, sequence, sock, data)
+timers = []
+timer_sequence = itertools.count()
+# Deadlines of the open connections and other housekeeping
+wheel = TimerWheel()
+connection_count = 0
 
-def get_client_info(client_id):
+
+def wake_loop():
+    """
+    Wake the selector from another thread. Safe to call at any rate; a full wakeup
+    socket already guarantees a pending wakeup.
+    """
+    try:
+        wakeup_sockets[1].send(b'\0')
+    except (BlockingIOError, OSError):
+        pass
+
+
+def notify_completed(sock, data):
+    """
+    Queue a connection whose crypto job finished and wake the selector.
+    """
+    completed.append((sock, data))
+    wake_loop()
+
+
+def update_events(sock, data):
+    """
+    Register exactly the events a connection currently needs: EVENT_READ while it may
+    take new requests and EVENT_WRITE only while output is queued, so idle writable
+    sockets never wake the loop. A connection needing neither is unregistered until
+    it does.
+    """
+    events = 0
+    if data.reading and not data.output_blocked and not data.throttled and not buffer_full(data):
+        events |= selectors.EVENT_READ
+    if data.outb:
+        events |= selectors.EVENT_WRITE
+    if events == data.events:
+        return
+    if not data.events:
+        selector.register(sock, events, data=data)
+    elif not events:
+        selector.unregister(sock)
+    else:
+        selector.modify(sock, events, data=data)
+    data.events = events
+
+
+def buffer_full(data):
     """
-    get client info and decoding it for representing
+    Tells whether a connection holds as many received bytes as its client may buffer.
+    A frame larger than the limit is still read completely.
     """
-    client = get_client(client_id)
-    client_id_hex = binascii.hexlify(client_id).decode()
-    username = client[1] if client else "Unknown"
-    return f"Client ID: {client_id_hex} (Username: {username})"
+    return (data.max_buffered is not None and data.decoder.buffered >= data.max_buffered
+            and data.decoder.frame_ready)
+
+
+def throttle(sock, data, delay):
+    """
+    Pause a connection whose client used up its bandwidth for delay seconds.
+    """
+    data.throttled = True
+    heapq.heappush(timers, (time.monotonic() + delay, next(timer_sequence), sock, data))
+    update_events(sock, data)
+
+
+def close_connection(sock, data):
+    """
+    Unregister a client socket from the selector and close it. Unfinished uploads
+    of the connection are kept so the client can resume them.
+    """
+    global connection_count
+    data.closed = True
+    data.timer.cancel()
+    connection_count -= 1
+    ACTIVE_CONNECTIONS.dec()
+    suspend_uploads(data.file_data)
+    if data.stream is not None:
+        data.stream.close()
+        data.stream = None
+    if data.trace_connection is not None:
+        get_capture().close_connection(data.trace_connection)
+    if data.events:
+        selector.unregister(sock)
+        data.events = 0
+    sock.close()
+
+
+def set_reading(sock, data, reading):
+    """
+    Enable or disable reading for a connection. Reading is paused while a request
+    of the connection waits on the crypto stage, so its requests stay in order and
+    a busy stage holds back new work.
+    """
+    data.reading = reading
+    update_events(sock, data)
+
+
+def process_frames(sock, data):
+    """
+    Process the buffered requests of a connection until they run out, a response
+    has to wait for the crypto stage, too much output is queued, a download is being
+    sent, the client used up its bandwidth or the connection processed TURN_QUANTUM
+    bytes in this loop turn.
+    """
+    if data.waiting_turn or data.throttled or data.stream is not None:
+        return  # Continued by run_turns, run_timers or flush_output
+    stage = get_stage()
+    frames = data.decoder.frames()
+    budget = TURN_QUANTUM
+    while True:
+        if data.decoder.buffered:
+            if stage is not None and stage.full:
+                # Backpressure: leave the requests buffered until a crypto worker is free
+                stalled.append((sock, data))
+                set_reading(sock, data, False)
+                return
+            if data.outb.above_high_watermark:
+                # The client is not reading its responses, wait until it catches up
+                data.output_blocked = True
+                update_events(sock, data)
+                return
+            if budget <= 0:
+                # Let the other ready connections go first, so bulk uploads cannot starve them
+                data.waiting_turn = True
+                turns.append((sock, data))
+                return
+        frame = next(frames, None)
+        if frame is None:
+            return
+        client_id, version, code, payload = frame
+        if data.trace_connection is not None:
+            get_capture().request(data.trace_connection, client_id, version, code, payload)
+        size = REQUEST_HEADER_SIZE + len(payload)
+        budget -= size
+        if client_id != data.client_id and client_id != ANONYMOUS_CLIENT:
+            data.client_id = client_id
+            data.max_buffered = get_limits(client_id)['max_buffered']
+        response = process_request(data, client_id, version, code, payload)
+        delay = charge(client_id, size)
+        if delay:
+            throttle(sock, data, delay)
+        if isinstance(response, Deferred):
+            data.deferred = response
+            set_reading(sock, data, False)
+            response.future.add_done_callback(lambda future: notify_completed(sock, data))
+            return
+        if isinstance(response, FileStream):
+            data.stream = response
+            if not pump_stream(data):
+                # Later requests wait until the download is queued, see flush_output
+                set_reading(sock, data, False)
+                return
+        else:
+            data.outb.write(response)
+        if data.throttled:
+            return
+
+
+def pump_stream(data):
+    """
+    Queue the next chunks of the connection's download until its output reaches the
+    high watermark. Returns True once the whole download is queued. Write interest
+    stays registered while output is queued, so the download advances as fast as
+    the client reads it and never faster.
+    """
+    stream = data.stream
+    while not stream.done:
+        if data.outb.above_high_watermark:
+            return False
+        for buffer in stream.next_chunk():
+            data.outb.write(buffer)
+    data.stream = None
+    return True
+
+
+def flush_output(sock, data):
+    """
+    Send queued responses and update the connection's events. Once the queue drains
+    below its low watermark, more of a download is queued, and requests held back by
+    the high watermark or the download are processed.
+    """
+    if data.outb:
+        start = time.perf_counter()
+        try:
+            BYTES_SENT.inc(data.outb.send(sock))
+            data.last_activity = time.monotonic()
+        except BlockingIOError:
+            pass
+        SEND_SECONDS.time_since(start)
+    if data.stream is not None and data.outb.below_low_watermark and pump_stream(data):
+        data.reading = True
+        process_frames(sock, data)
+    if data.output_blocked and data.outb.below_low_watermark:
+        data.output_blocked = False
+        process_frames(sock, data)
+    update_events(sock, data)
+
+
+def resume_connection(sock, data):
+    """
+    Continue a connection that was paused for the crypto stage: queue its finished
+    response and process the requests that arrived in the meantime.
+    """
+    if data.closed:
+        return  # The connection was closed while it was paused
+    try:
+        if data.deferred is not None:
+            if not data.deferred.done():
+                return
+            response, data.deferred = data.deferred.resolve(), None
+            data.outb.write(response)
+        data.reading = data.stream is None
+        process_frames(sock, data)
+        flush_output(sock, data)
+    except Exception as e:
+        logging.error("Error handling client %s: %s", data.addr, e)
+        close_connection(sock, data)
+
+
+def handle_wakeup(sock):
+    """
+    Handle a wakeup from the crypto stage: resume connections whose jobs finished and,
+    if there is room again, connections that were stalled by backpressure.
+    """
+    try:
+        while sock.recv(4096):
+            pass
+    except BlockingIOError:
+        pass
+    while completed:
+        resume_connection(*completed.popleft())
+    stage = get_stage()
+    while stalled and not (stage is not None and stage.full):
+        resume_connection(*stalled.popleft())
+
+
+def run_turns():
+    """
+    Give each connection that used up its share of the previous turn another one,
+    in the order they were queued.
+    """
+    for _ in range(len(turns)):
+        sock, data = turns.popleft()
+        data.waiting_turn = False
+        resume_connection(sock, data)
+
+
+def run_timers():
+    """
+    Resume the connections whose clients may send again.
+    """
+    now = time.monotonic()
+    while timers and timers[0][0] <= now:
+        _, _, sock, data = heapq.heappop(timers)
+        data.throttled = False
+        resume_connection(sock, data)
+
+
+def select_timeout():
+    """
+    Return how long the selector may wait: not at all while connections wait for
+    their turn, and at most until the next paused connection may continue or the
+    next tick of the timer wheel.
+    """
+    if turns:
+        return 0
+    timeout = wheel.timeout()
+    if timers:
+        delay = max(0.0, timers[0][0] - time.monotonic())
+        timeout = delay if timeout is None else min(timeout, delay)
+    return timeout
+
+
+def check_connection(sock, data):
+    """
+    Close a connection that passed its idle, header or transfer deadline, or check
+    it again at its next deadline. Activity only updates timestamps, so a busy
+    connection costs one timer per deadline period rather than one per request.
+    """
+    if data.closed:
+        return
+    now = time.monotonic()
+    reason, deadline = connection_deadline(data, now, bool(data.events & selectors.EVENT_READ))
+    if reason is not None:
+        logging.info("Closing connection from %s: %s", data.addr, reason)
+        close_connection(sock, data)
+        return
+    data.timer = wheel.schedule(deadline - now, lambda: check_connection(sock, data))
+
+
+def sweep_stale_uploads():
+    """
+    Delete the interrupted uploads nobody resumed in time, and schedule the next sweep.
+    """
+    try:
+        discard_stale_uploads()
+    except Exception as e:
+        logging.error("Could not remove stale uploads: %s", e)
+    wheel.schedule(STALE_UPLOAD_SWEEP_INTERVAL, sweep_stale_uploads)
+
+
+def refuse_connection(conn, addr):
+    """
+    Turn away a connection while the server is at its connection limit: the client
+    gets a general error right away instead of waiting for a server that is full.
+    """
+    logging.info("Refused connection from %s: %d connections are open", addr, connection_count)
+    conn.setblocking(False)
+    try:
+        conn.send(create_general_error(bytes(16)))
+    except OSError:
+        pass
+    conn.close()
+
 
 def handle_client(key, mask):
     """
@@ -54,150 +388,203 @@ def handle_client(key, mask):
     """
     sock = key.fileobj
     data = key.data
-    if not hasattr(data, 'file_data'):
-        data.file_data = {}  # Initialize file_data if it doesn't exist
-    if mask & selectors.EVENT_READ:
-        try:
-            # Read the header of the incoming message
-            header = sock.recv(23)
-            if not header:
-                logging.info(f"Client {data.addr} closed the connection")
-                selector.unregister(sock)
-                sock.close()
+    try:
+        if mask & selectors.EVENT_READ:
+            # Read whatever is available; only complete frames are processed
+            try:
+                received = data.decoder.recv_into(sock)
+            except BlockingIOError:
                 return
-            client_id, version, code, payload_size = parse_request_header(header)
-            payload = sock.recv(payload_size)
-            parsed_data = parse_request_payload(code, payload, data.file_data)
-            client_info = get_client_info(client_id)
-
-            # Handle different types of requests based on the code
-            if code == 825:  # Client registration
-                logging.info(f"Received client registration request from {client_info}")
-                if get_client_by_name(parsed_data['name']):
-                    logging.warning(f"Registration failed: Username {parsed_data['name']} already exists")
-                    response = create_registration_failed()
-                else:
-                    new_client_id = uuid.uuid4().bytes
-                    aes_key = generate_aes_key()
-                    add_client(new_client_id, parsed_data['name'], aes_key)
-                    logging.info(f"{client_info} registered successfully")
-                    response = create_registration_success(new_client_id)
-            elif code == 826:  # Public key update
-                logging.info(f"Received public key update from {client_info}")
-                update_client_key(client_id, parsed_data['public_key'])
-                aes_key = get_client_aes_key(client_id)
-                encrypted_aes_key = encrypt_aes_key(aes_key, parsed_data['public_key'])
-                logging.info(f"Public key updated for {client_info}. Sending encrypted AES key.")
-                response = create_public_key_accepted(client_id, encrypted_aes_key)
-            elif code == 827:  # Reconnect
-                client = get_client(client_id)
-                if client and client[1] == parsed_data['name']:  # Check if client exists and name matches
-                    username = parsed_data['name']
-                    logging.info(f"Received reconnection request from {client_info}")
-                    aes_key = get_client_aes_key(client_id)
-                    encrypted_aes_key = encrypt_aes_key(aes_key, client[2])  # Encrypt with stored public key
-                    logging.info(f"{client_info} reconnected successfully")
-                    response = create_reconnect_confirm(client_id, encrypted_aes_key)
-                else:
-                    logging.warning(f"Reconnection failed for client {client_id}")
-                    response = create_reconnect_denied(client_id)
-            elif code == 828:  # File content
-                try:
-                    parsed_data = parse_request_payload(code, payload, data.file_data)
-                    if 'packet_number' in parsed_data:
-                        logging.info(f"Received file chunk {parsed_data['packet_number']}/{parsed_data['total_packets']} from {client_info}")
-                    if parsed_data['is_complete']:
-                        logging.info(f"File transfer complete for {parsed_data['file_name']} from {client_info}")
-                        aes_key = get_client_aes_key(client_id)
-                        decrypted_content = decrypt_aes(parsed_data['content'], aes_key)
-                        # Check if the decrypted size matches the expected size
-                        if len(decrypted_content) != parsed_data['orig_file_size']:
-                            logging.warning(f"Size mismatch: expected {parsed_data['orig_file_size']}, got {len(decrypted_content)}")
-                        file_path = process_file_content(client_id, parsed_data['file_name'], decrypted_content)
-                        if file_path:
-                            crc = calculate_crc(file_path)
-                            logging.info(f"File received and CRC calculated for client {client_info}")
-                            response = create_file_accepted(client_id, parsed_data['orig_file_size'],
-                                                            parsed_data['file_name'], crc)
-                        else:
-                            logging.warning(f"File processing failed for client {client_info}")
-                            response = create_general_error(client_id)
-
-                        # Clear the file data after processing
-                        del data.file_data[parsed_data['file_name']]
-                    else:
-                        # Acknowledge receipt of the chunk
-                        response = create_message_accepted(client_id)
-
-                except ValueError as e:
-                    logging.error(f"Error processing file content: {str(e)}")
-                    response = create_general_error(client_id)
-
-            elif code == 900:  # CRC correct
-                logging.info(f"CRC correct for file from client {client_info}")
-                response = create_message_accepted(client_id)
-            elif code == 901:  # CRC incorrect, client will retry
-                logging.info(f"CRC incorrect for file from client {client_info}, client will retry")
-                response = create_message_accepted(client_id)
-            elif code == 902:  # CRC incorrect, final failure
-                logging.warning(f"File transfer failed after multiple attempts for client {client_info}")
-                response = create_message_accepted(client_id)
+            if not received:
+                logging.info("Client %s closed the connection", data.addr)
+                close_connection(sock, data)
+                return
+            BYTES_RECEIVED.inc(received)
+            data.last_activity = time.monotonic()
+            process_frames(sock, data)
+            # A started request header has to be completed within the header timeout
+            if 0 < data.decoder.buffered < REQUEST_HEADER_SIZE:
+                if data.header_started is None:
+                    data.header_started = data.last_activity
             else:
-                logging.warning(f"Unknown command {code} from client {client_id}")
-                response = create_general_error(client_id)
-
-            data.outb += response
-        except Exception as e:
-            logging.error(f"Error handling client {data.addr}: {e}")
-            selector.unregister(sock)
-            sock.close()
-
-    if mask & selectors.EVENT_WRITE:
-        if data.outb:
-            try:
-                sent = sock.send(data.outb)
-                data.outb = data.outb[sent:]
-            except Exception as e:
-                logging.error(f"Error sending data to client {data.addr}: {e}")
-                selector.unregister(sock)
-                sock.close()
+                data.header_started = None
+        # Responses are sent right away; EVENT_WRITE is only used for what remains
+        flush_output(sock, data)
+    except Exception as e:
+        logging.error("Error handling client %s: %s", data.addr, e)
+        close_connection(sock, data)
 
 
 def accept_connection(sock):
     """
-    Accept a new client connection and register it with the selector.
+    Accept a new client connection and register it with the selector. The client
+    has to send its first request header within the header timeout.
     """
-    conn, addr = sock.accept()
-    logging.info(f"Accepted connection from {addr}")
+    global connection_count
+    try:
+        conn, addr = sock.accept()
+    except BlockingIOError:
+        return  # Another worker process accepted the connection first
+    if at_connection_limit(connection_count):
+        refuse_connection(conn, addr)
+        return
+    logging.info("Accepted connection from %s", addr)
+    connection_count += 1
+    ACTIVE_CONNECTIONS.inc()
     conn.setblocking(False)
-    data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    selector.register(conn, events, data=data)
+    now = time.monotonic()
+    data = types.SimpleNamespace(addr=addr, decoder=FrameDecoder(), outb=OutputQueue(), file_data={},
+                                 reading=True, output_blocked=False, deferred=None, events=0, closed=False,
+                                 client_id=None, max_buffered=default_max_buffered(), throttled=False,
+                                 waiting_turn=False, last_activity=now, header_started=now, timer=None,
+                                 stream=None, trace_connection=None)
+    trace = get_capture()
+    if trace is not None:
+        data.trace_connection = trace.open_connection(addr)
+    update_events(conn, data)
+    check_connection(conn, data)
 
 
-def start_server():
+def start_server(server_socket=None):
     """
-    Start the server and enter the main event loop.
+    Start the server and enter the main event loop. A listening socket created by
+    the worker supervisor can be passed in; otherwise one is bound to HOST:PORT.
     """
+    global wakeup_sockets
     setup_database()
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen()
-    server_socket.setblocking(False)
+    sweep_stale_uploads()
+    collect_blobs()
+    wakeup_sockets = socket.socketpair()
+    for wakeup_socket in wakeup_sockets:
+        wakeup_socket.setblocking(False)
+    selector.register(wakeup_sockets[0], selectors.EVENT_READ, data=WAKEUP)
+    stage = get_stage()
+    if stage is not None:
+        stage.on_complete = wake_loop
+    if server_socket is None:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.bind((HOST, PORT))
+        server_socket.listen()
+        server_socket.setblocking(False)
+        logging.info("Server listening on %s:%s", HOST, PORT)
     selector.register(server_socket, selectors.EVENT_READ, data=None)
-    logging.info(f"Server listening on {HOST}:{PORT}")
 
-    while True:
-        # Main event loop: continuously check for new connections and client events
-        events = selector.select(timeout=None)
-        for key, mask in events:
-            if key.data is None:
-                accept_connection(key.fileobj)
-            else:
-                handle_client(key, mask)
+    try:
+        while True:
+            # Main event loop: continuously check for new connections and client events
+            events = selector.select(timeout=select_timeout())
+            start = time.perf_counter()
+            for key, mask in events:
+                if key.data is None:
+                    accept_connection(key.fileobj)
+                elif key.data is WAKEUP:
+                    handle_wakeup(key.fileobj)
+                else:
+                    handle_client(key, mask)
+            run_timers()
+            run_turns()
+            wheel.advance()
+            # Events that became ready meanwhile waited this long for the loop
+            LOOP_LAG_SECONDS.time_since(start)
+    finally:
+        close_database()
+
+
+def parse_args():
+    """
+    Parse the command line options that select the server engine.
+    """
+    parser = argparse.ArgumentParser(description="Secure file transfer server")
+    parser.add_argument('--engine', choices=['selectors', 'asyncio'], default='selectors',
+                        help="event loop implementation to run (default: selectors)")
+    parser.add_argument('--uvloop', action='store_true',
+                        help="use uvloop for the asyncio engine when it is installed")
+    parser.add_argument('--executor-workers', type=int, default=None,
+                        help="thread pool size for blocking work in the asyncio engine")
+    parser.add_argument('--crypto-workers', type=int, default=None,
+                        help="crypto stage workers (default: one per CPU, 0 runs crypto inline)")
+    parser.add_argument('--crypto-pool', choices=['thread', 'process'], default='thread',
+                        help="run crypto jobs on threads or processes (default: thread)")
+    parser.add_argument('--crypto-queue', type=int, default=DEFAULT_MAX_PENDING,
+                        help="crypto jobs accepted before backpressure applies")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of server processes sharing the port (default: 1)")
+    parser.add_argument('--checksum', choices=CHECKSUMS, default='crc32',
+                        help="checksum sent back for received files: crc32 (the C++ client) or POSIX cksum")
+    parser.add_argument('--quotas', default=QUOTAS_FILE,
+                        help=f"JSON file with per-client bandwidth, upload and buffer limits (default: {QUOTAS_FILE})")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help=f"seconds before a silent connection is closed (default: {IDLE_TIMEOUT:.0f})")
+    parser.add_argument('--header-timeout', type=float, default=HEADER_TIMEOUT,
+                        help=f"seconds to complete a started request header (default: {HEADER_TIMEOUT:.0f})")
+    parser.add_argument('--transfer-timeout', type=float, default=TRANSFER_TIMEOUT,
+                        help=f"seconds an upload may go without a chunk being accepted "
+                             f"(default: {TRANSFER_TIMEOUT:.0f})")
+    parser.add_argument('--max-transfer-time', type=float, default=MAX_TRANSFER_TIME,
+                        help="seconds an upload may take on one connection, however it progresses (default: no limit)")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help=f"open connections per server process before new ones are refused "
+                             f"(default: {MAX_CONNECTIONS})")
+    parser.add_argument('--capture', default=None, metavar='PATH',
+                        help="record every request with its arrival time to a trace file for replay.py; "
+                             "with --workers, worker N writes PATH.N")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help="lowest level of log messages written (default: INFO)")
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='json',
+                        help="write log messages as JSON lines or as plain text (default: json)")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve metrics on http://127.0.0.1:PORT/metrics (worker N uses PORT + N)")
+    return parser.parse_args()
+
+
+def run_server(args, server_socket=None, slot=0):
+    """
+    Run one server process with the selected engine.
+    """
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port + slot)
+    configure_stage(args.crypto_pool, args.crypto_workers, args.crypto_queue)
+    configure_checksum(args.checksum)
+    load_quotas(args.quotas)
+    configure_lifecycle(args.idle_timeout, args.header_timeout, args.transfer_timeout, args.max_connections,
+                        args.max_transfer_time)
+    if args.capture is not None:
+        setup_database()
+        start_capture(args.capture if args.workers <= 1 else f"{args.capture}.{slot}")
+    if args.engine == 'asyncio':
+        from async_server import start_async_server
+        start_async_server(HOST, PORT, use_uvloop=args.uvloop, max_workers=args.executor_workers,
+                           server_socket=server_socket)
+    else:
+        start_server(server_socket)
+
+
+def run_worker(args, server_socket, slot):
+    """
+    Entry point of a worker process started by the supervisor. Workers keep their
+    own database connections and check the shared clients table for changes made
+    by the other workers.
+    """
+    global selector
+    # An epoll selector created before the fork would be shared by all workers
+    selector = selectors.DefaultSelector()
+    # The log writer thread of the supervisor does not exist in the forked worker
+    setup_logging(args.log_level, args.log_format)
+    configure_database()
+    client_cache.shared = True
+    run_server(args, server_socket, slot)
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_level, args.log_format)
     if not os.path.exists('uploads'):
         os.makedirs('uploads')
-    start_server()
\ No newline at end of file
+    if args.workers > 1:
+        from workers import run_workers
+        # Create the schema once, then close the connections so none cross the fork
+        setup_database()
+        close_database()
+        run_workers(HOST, PORT, args.workers, lambda server_socket, slot: run_worker(args, server_socket, slot))
+    else:
+        run_server(args)
\ No newline at end of file
@@ -0,0 +1,264 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from 50 microseconds up to 10 seconds
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.25  # Seconds between two loop lag probes of the asyncio engine
+
+_registry = []
+
+
+class _CounterValue:
+    """
+    A single counter of a metric family. Its value is either counted here or read
+    from a function, for counts another component keeps, when the metrics are
+    rendered.
+    """
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class _GaugeValue:
+    """
+    A single gauge of a metric family. Its value is either set directly or read
+    from a function when the metrics are rendered.
+    """
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramValue:
+    """
+    A single histogram of a metric family. Only the bucket an observation falls in
+    is counted; the cumulative counts are built when rendering.
+    """
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time_since(self, start):
+        """
+        Observes the time elapsed since start, a time.perf_counter() value.
+        """
+        self.observe(time.perf_counter() - start)
+
+
+class Metric:
+    """
+    A family of metrics sharing a name, with one value per combination of label
+    values. Callers on hot paths look up their labelled value once with labels()
+    and keep it, so recording is a single method call.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *labelvalues):
+        """
+        Returns the value for the given label values, creating it on first use.
+        """
+        value = self._values.get(labelvalues)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(labelvalues, self._new_value())
+        return value
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def _label_text(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for name, value in pairs) + '}'
+
+    def render(self):
+        """
+        Returns the lines of this family in the Prometheus text format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, value in sorted(self._values.items(), key=lambda item: str(item[0])):
+            lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+
+class Counter(Metric):
+    """
+    A family of values that only go up, such as request or byte counts.
+    """
+    kind = 'counter'
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def _render_value(self, labelvalues, value):
+        return [f"{self.name}{self._label_text(labelvalues)} {value.get()}"]
+
+
+class Gauge(Metric):
+    """
+    A family of values that go up and down, such as open connections.
+    """
+    kind = 'gauge'
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def _render_value(self, labelvalues, value):
+        return [f"{self.name}{self._label_text(labelvalues)} {value.get()}"]
+
+
+class Histogram(Metric):
+    """
+    A family of distributions of observed values, such as latencies.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def _render_value(self, labelvalues, value):
+        with value._lock:
+            counts, total, count = list(value.counts), value.sum, value.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{self._label_text(labelvalues, [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(labelvalues)} {total}")
+        lines.append(f"{self.name}_count{self._label_text(labelvalues)} {count}")
+        return lines
+
+
+def render_metrics():
+    """
+    Returns every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter('server_requests_total', "Requests handled, by request code", ['code'])
+REQUEST_SECONDS = Histogram('server_request_seconds', "Time from parsing a request to its response being ready, "
+                            "by request code", ['code'])
+PHASE_SECONDS = Histogram('server_phase_seconds', "Time spent per processing phase: parse, db, crypto "
+                          "(including the wait for a crypto worker), disk and send", ['phase'])
+PARSE_SECONDS = PHASE_SECONDS.labels('parse')
+DB_SECONDS = PHASE_SECONDS.labels('db')
+CRYPTO_SECONDS = PHASE_SECONDS.labels('crypto')
+DISK_SECONDS = PHASE_SECONDS.labels('disk')
+SEND_SECONDS = PHASE_SECONDS.labels('send')
+BYTES_RECEIVED = Counter('server_received_bytes_total', "Bytes received from clients").labels()
+BYTES_SENT = Counter('server_sent_bytes_total', "Bytes sent to clients").labels()
+ACTIVE_CONNECTIONS = Gauge('server_active_connections', "Open client connections").labels()
+UPLOADS_IN_FLIGHT = Gauge('server_uploads_in_flight', "Uploads with an open temporary file").labels()
+DOWNLOADS_IN_FLIGHT = Gauge('server_downloads_in_flight', "Downloads with an open stored file").labels()
+COMPRESSED_BYTES = Counter('server_upload_compressed_bytes_total', "Content of finished compressed uploads "
+                           "before decompression, by compression method", ['method'])
+DECOMPRESSED_BYTES = Counter('server_upload_decompressed_bytes_total', "Content of finished compressed uploads "
+                             "after decompression, by compression method", ['method'])
+COMPRESSION_RATIO = Histogram('server_upload_compression_ratio', "Decompressed to compressed size of finished "
+                              "compressed uploads, by compression method", ['method'],
+                              buckets=(1.0, 1.25, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0, 12.0, 16.0, 32.0, 64.0))
+CLIENT_CACHE_LOOKUPS = Counter('server_client_cache_lookups_total', "Client session cache lookups, by result: "
+                              "hit or miss", ['result'])
+CLIENT_CACHE_SESSIONS = Gauge('server_client_cache_sessions', "Client sessions in the cache").labels()
+KEY_CACHE_LOOKUPS = Counter('server_public_key_cache_lookups_total', "Parsed public key cache lookups of the "
+                            "key wraps run in this process, by result: hit or miss", ['result'])
+KEY_CACHE_KEYS = Gauge('server_public_key_cache_keys', "Parsed public keys in the cache of this process").labels()
+LOOP_LAG_SECONDS = Histogram('server_loop_lag_seconds', "How long a ready event can wait for the event loop: "
+                             "the busy time of one selectors loop iteration, or the lateness of a periodic "
+                             "asyncio timer").labels()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics text on /metrics.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serves the metrics over HTTP on a background thread, so a Prometheus server or
+    curl can read them from http://host:port/metrics. Returns the HTTP server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
@@ -0,0 +1,88 @@
+import os
+import socket
+from collections import deque
+
+# Buffered output above which a connection stops reading new requests
+HIGH_WATERMARK = 256 * 1024
+# Buffered output below which reading resumes
+LOW_WATERMARK = 64 * 1024
+# Maximum number of buffers passed to a single sendmsg() call
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+
+class OutputQueue:
+    """
+    Per-connection queue of outgoing responses. Responses are queued as memoryviews
+    and sent with a single scatter-gather sendmsg() call where the platform has one;
+    a partial send only advances a view, so the remaining data is never copied.
+
+    The high and low watermarks tell the server loop when to stop reading requests
+    from a client that does not read its responses, and when to start again.
+    """
+
+    def __init__(self, high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self._buffers = deque()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    @property
+    def above_high_watermark(self):
+        """
+        Tells whether enough output is queued that the connection should stop reading.
+        """
+        return self._size >= self.high_watermark
+
+    @property
+    def below_low_watermark(self):
+        """
+        Tells whether the queue drained far enough for reading to resume.
+        """
+        return self._size <= self.low_watermark
+
+    def write(self, data):
+        """
+        Queues data for sending. The data is referenced, not copied, and must not be
+        modified afterwards.
+        """
+        if data:
+            self._buffers.append(memoryview(data))
+            self._size += len(data)
+
+    def send(self, sock):
+        """
+        Sends as much queued data as the socket accepts and returns the number of
+        bytes sent. Raises BlockingIOError only if nothing could be sent.
+        """
+        if not self._buffers:
+            return 0
+        if HAS_SENDMSG and len(self._buffers) > 1:
+            buffers = [self._buffers[i] for i in range(min(len(self._buffers), IOV_MAX))]
+            sent = sock.sendmsg(buffers)
+        else:
+            sent = sock.send(self._buffers[0])
+        self._consume(sent)
+        return sent
+
+    def _consume(self, count):
+        """
+        Drops count sent bytes from the front of the queue.
+        """
+        self._size -= count
+        while count:
+            head = self._buffers[0]
+            if count < len(head):
+                self._buffers[0] = head[count:]
+                return
+            count -= len(head)
+            self._buffers.popleft()
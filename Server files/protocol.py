@@ -1,80 +1,259 @@
 import struct
+import time
 
-def parse_request_header(data):
+# Request header layout: client ID (16 bytes), version (1), code (2), payload size (4)
+REQUEST_HEADER = struct.Struct('<16sBHI')
+REQUEST_HEADER_SIZE = REQUEST_HEADER.size
+
+PROTOCOL_VERSION = 3
+# Clients that send file chunks with this version or later keep a window of chunks
+# in flight and receive cumulative 1608 acks instead of a 1604 for every chunk
+WINDOWED_VERSION = 4
+# File chunks sent with this version or later carry a compression method byte
+# after the file name; the content is compressed before it is encrypted
+COMPRESSED_VERSION = 5
+# File chunks sent with this version or later carry a cipher suite byte and an
+# 8 byte transfer nonce after the compression method. With a suite other than CBC
+# (0) every chunk is encrypted and authenticated on its own
+SEALED_VERSION = 6
+# Offset of the content in an 828 payload, without and with the compression byte,
+# and with the cipher suite and transfer nonce
+CHUNK_CONTENT_OFFSET = 267
+COMPRESSED_CHUNK_CONTENT_OFFSET = 268
+SEALED_CHUNK_CONTENT_OFFSET = 277
+# A windowed client is acked at least every ACK_INTERVAL in-order chunks, so its
+# window must hold at least this many chunks
+ACK_INTERVAL = 8
+# Maximum number of chunks held back while waiting for a missing earlier chunk
+MAX_REORDER_CHUNKS = 256
+# Request codes of the protocol; metrics count every other code under one label
+REQUEST_CODES = frozenset((825, 826, 827, 828, 829, 830, 900, 901, 902))
+
+
+def parse_request_header(data, offset=0):
     """
     Parses the header of an incoming request. The header contains crucial information
     about the client and the type of request being made. This function extracts the
     client ID, protocol version, request code, and payload size from the binary header data.
+    The header is read in place starting at offset, so data may be any buffer (bytes,
+    bytearray or memoryview) holding more than one header.
+    """
+    return REQUEST_HEADER.unpack_from(data, offset)
+
+
+def decode_name(data):
+    """
+    Decodes a null-padded name field (username or file name) from a request payload.
+    Accepts any bytes-like object so payloads can be handed over as memoryview slices.
+    """
+    return str(data, 'utf-8', errors='replace').rstrip('\0')
+
+
+def create_file_info(total_packets, content_size, orig_file_size, compression=0, cipher=0):
+    """
+    Creates the bookkeeping entry for a file transfer, as kept in a connection's
+    file_data under the file name.
+    """
+    return {
+        'compression': compression,
+        'cipher': cipher,
+        'started': time.monotonic(),  # When the transfer started on this connection
+        'last_progress': time.monotonic(),  # When the last chunk was accepted
+        'total_packets': total_packets,
+        'received_packets': 0,
+        'received_size': 0,
+        'content_size': content_size,
+        'orig_file_size': orig_file_size,
+        'pending': {},
+        'acked_packets': 0
+    }
+
+
+def chunk_bitmap(total_packets, received_packets, extra=()):
+    """
+    Builds the bitmap of received chunks: bit (n - 1) % 8 of byte (n - 1) // 8 is set
+    when chunk n was received. Chunks 1 to received_packets are set, plus the packet
+    numbers in extra.
+    """
+    bitmap = bytearray((total_packets + 7) // 8)
+    full_bytes = received_packets // 8
+    bitmap[:full_bytes] = b'\xff' * full_bytes
+    for packet_number in range(full_bytes * 8 + 1, received_packets + 1):
+        bitmap[(packet_number - 1) // 8] |= 1 << ((packet_number - 1) % 8)
+    for packet_number in extra:
+        bitmap[(packet_number - 1) // 8] |= 1 << ((packet_number - 1) % 8)
+    return bytes(bitmap)
+
+
+def contiguous_packets(bitmap, total_packets):
+    """
+    Returns how many chunks from the first one on are set in a chunk bitmap.
+    """
+    count = 0
+    for byte in bitmap:
+        if byte != 0xff:
+            while byte & 1:
+                count += 1
+                byte >>= 1
+            break
+        count += 8
+    return min(count, total_packets)
+
+
+def chunk_wanted(file_info, packet_number):
+    """
+    Tells whether a file chunk is new to the transfer. Duplicates and chunks out of
+    range were already acked or are ignored. Raises ValueError if the chunk would
+    have to be held back while too many others are.
+    """
+    pending = file_info['pending']
+    next_packet = file_info['received_packets'] + 1
+    if packet_number < next_packet or packet_number in pending or packet_number > file_info['total_packets']:
+        return False
+    if packet_number > next_packet and len(pending) >= MAX_REORDER_CHUNKS:
+        raise ValueError(f"Too many chunks received out of order, chunk {next_packet} is missing.")
+    return True
+
+
+def order_chunk(file_info, packet_number, content):
     """
-    return struct.unpack('<16sBHI', data)
+    Puts a file chunk in its place in the transfer. Chunks that arrive ahead of a
+    missing one are held back; once the missing chunk arrives, it is returned joined
+    with every held back chunk that now follows in order. Returns the content that
+    can be processed now, which is empty for held back or duplicate chunks.
+    """
+    if not chunk_wanted(file_info, packet_number):
+        return b''
+    file_info['last_progress'] = time.monotonic()
+    pending = file_info['pending']
+    if packet_number > file_info['received_packets'] + 1:
+        pending[packet_number] = bytes(content)  # The payload buffer is reused by the next read
+        return b''
+    file_info['received_packets'] = packet_number
+    if not pending:
+        return content
+    run = [content]
+    while file_info['received_packets'] + 1 in pending:
+        file_info['received_packets'] += 1
+        run.append(pending.pop(file_info['received_packets']))
+    return b''.join(run)
 
 
-def parse_request_payload(code, payload, file_data):
+def transfer_complete(file_info):
+    """
+    Tells whether every chunk of a transfer arrived in order. Raises ValueError if
+    the chunks do not add up to the announced content size.
+    """
+    if file_info['received_packets'] != file_info['total_packets']:
+        return False
+    if file_info['received_size'] != file_info['content_size']:
+        raise ValueError(f"Expected {file_info['content_size']} bytes of content, got {file_info['received_size']}.")
+    return True
+
+
+def parse_request_payload(code, payload, file_data, windowed=False, compressed=False, sealed=False):
     """
     Parses the payload of an incoming request based on its code. Different request types
     (e.g., registration, key updates, file transfers) have different payload structures.
     This function interprets the payload according to the request type and returns the
     relevant data in a dictionary format.
+    File chunks of windowed transfers are ordered by their packet number, other chunks
+    are taken in the order they arrive. Compressed chunks carry their compression method.
+    Sealed chunks carry their cipher suite; unless it is CBC they are not ordered here
+    but after they were decrypted, and is_complete is left to the caller.
+    A chunk whose chunk count or sizes differ from the transfer under its file name
+    starts a new transfer; the entry it replaced is returned as replaced.
     """
     if code == 825:  # Client registration
-        name = payload[:255].decode('utf-8', errors='replace').rstrip('\0')
+        name = decode_name(payload[:255])
         return {'name': name}
     elif code == 826:  # Public key update
-        name = payload[:255].decode('utf-8', errors='replace').rstrip('\0')
-        public_key = payload[255:415]
+        name = decode_name(payload[:255])
+        public_key = bytes(payload[255:415])
         return {'name': name, 'public_key': public_key}
     elif code == 827:  # Reconnect
-        name = payload[:255].decode('utf-8', errors='replace').rstrip('\0')
+        name = decode_name(payload[:255])
         return {'name': name}
     elif code == 828:  # File content
-        if len(payload) < 267:
+        if sealed:
+            content_offset = SEALED_CHUNK_CONTENT_OFFSET
+        else:
+            content_offset = COMPRESSED_CHUNK_CONTENT_OFFSET if compressed else CHUNK_CONTENT_OFFSET
+        if len(payload) < content_offset:
             raise ValueError("Payload too short for file content.")
         content_size, orig_file_size = struct.unpack('<II', payload[:8])
         packet_number, total_packets = struct.unpack('<HH', payload[8:12])
 
-        file_name = payload[12:267].decode('utf-8', errors='replace').rstrip('\0')
+        file_name = decode_name(payload[12:267])
+        compression = payload[267] if compressed or sealed else 0
+        cipher = payload[268] if sealed else 0
 
-        content = payload[267:]
+        content = payload[content_offset:]
 
+        replaced = file_data.get(file_name)
+        if replaced is not None and (replaced['total_packets'], replaced['content_size'],
+                                     replaced['orig_file_size']) != (total_packets, content_size, orig_file_size):
+            # A different file is sent under the name of an earlier transfer, such as
+            # a restored interrupted upload; the earlier transfer is left to the caller
+            del file_data[file_name]
+        else:
+            replaced = None
         if file_name not in file_data:
-            file_data[file_name] = {
-                'content': bytearray(),
-                'total_packets': total_packets,
-                'received_packets': 0,
-                'content_size': content_size,
-                'orig_file_size': orig_file_size
-            }
-
-        file_data[file_name]['content'].extend(content)
-
-        is_complete = file_data[file_name]['received_packets'] == total_packets
-        if is_complete:
-            file_content = file_data[file_name]['content']
-            if len(file_content) != content_size:
-                raise ValueError(f"Expected {content_size} bytes of content, got {len(file_content)}.")
-
-        return {
+            file_data[file_name] = create_file_info(total_packets, content_size, orig_file_size, compression, cipher)
+
+        # Only the transfer bookkeeping is kept here, the content is streamed to disk
+        file_info = file_data[file_name]
+        if compression != file_info['compression']:
+            raise ValueError(f"Compression method changed during the transfer of {file_name}.")
+        if cipher != file_info['cipher']:
+            raise ValueError(f"Cipher suite changed during the transfer of {file_name}.")
+        parsed = {
             'file_name': file_name,
-            'content': content,
-            'is_complete': is_complete,
             'packet_number': packet_number,
             'total_packets': total_packets,
             'content_size': content_size,
-            'orig_file_size': orig_file_size
+            'orig_file_size': orig_file_size,
+            'replaced': replaced
         }
+        if cipher:
+            # The chunk is ordered once it was opened; the header is authenticated with
+            # it, except for the packet number, which is part of the nonce
+            wanted = chunk_wanted(file_info, packet_number)
+            if wanted:
+                file_info['received_size'] += len(content)
+            parsed.update(content=content if wanted else b'', wanted=wanted, is_complete=False,
+                          transfer_nonce=bytes(payload[269:277]),
+                          associated_data=bytes(payload[:8]) + bytes(payload[10:content_offset]))
+            return parsed
+        if not windowed:
+            # Older clients send their chunks in order and do not rely on packet numbers
+            packet_number = parsed['packet_number'] = file_info['received_packets'] + 1
+        content = order_chunk(file_info, packet_number, content)
+        file_info['received_size'] += len(content)
+        parsed.update(content=content, is_complete=transfer_complete(file_info))
+        return parsed
+    elif code == 829:  # Upload status, sent before resuming an interrupted upload
+        file_name = decode_name(payload[:255])
+        return {'file_name': file_name}
+    elif code == 830:  # File download, of the whole file or of length bytes from offset
+        if len(payload) < 263:
+            raise ValueError("Payload too short for a download request.")
+        file_name = decode_name(payload[:255])
+        offset, length = struct.unpack('<II', payload[255:263])
+        return {'file_name': file_name, 'offset': offset, 'length': length}
     elif code in [900, 901, 902]:  # CRC requests
-        file_name = payload.decode('utf-8', errors='replace').rstrip('\0')
+        file_name = decode_name(payload[:255])
         return {'file_name': file_name}
     return {}
 
 
-def create_response_header(code, payload_size):
+def create_response_header(code, payload_size, version=PROTOCOL_VERSION):
     """
     Creates a header for outgoing responses. The header includes the protocol version,
     response code, and payload size. This standardized header format allows the client
     to properly interpret the incoming response data.
     """
-    return struct.pack('<BHI', 3, code, payload_size)  # Version is always 3
+    return struct.pack('<BHI', version, code, payload_size)
 
 
 def create_registration_success(client_id):
@@ -122,6 +301,48 @@ def create_message_accepted(client_id):
     return create_response_header(1604, 16) + client_id
 
 
+def create_chunks_acked(client_id, file_name, packet_number):
+    """
+    Creates a cumulative acknowledgement for a windowed file transfer. It confirms
+    every chunk up to and including packet_number, so the client can move its
+    window forward; a lost ack is covered by the next one.
+    """
+    file_name_bytes = file_name.encode('ascii').ljust(255, b'\0')
+    payload = client_id + file_name_bytes + struct.pack('<H', packet_number)
+    return create_response_header(1608, len(payload), WINDOWED_VERSION) + payload
+
+
+def create_upload_status(client_id, file_name, total_packets, bitmap):
+    """
+    Creates the answer to an upload status request. The bitmap marks the chunks the
+    server already has, so the client only sends the others. total_packets is 0 and
+    the bitmap empty when there is no upload to resume.
+    """
+    file_name_bytes = file_name.encode('ascii').ljust(255, b'\0')
+    payload = client_id + file_name_bytes + struct.pack('<H', total_packets) + bitmap
+    return create_response_header(1609, len(payload)) + payload
+
+
+def download_chunk_prefix(client_id, file_name, file_size, offset, packet_number, total_packets, transfer_nonce):
+    """
+    Creates the part of a download chunk response before its sealed content: the
+    size of the whole file, the offset of the chunk's content in the file, its chunk
+    number and count and the transfer nonce. The prefix is authenticated with the
+    chunk as its associated data.
+    """
+    file_name_bytes = file_name.encode('ascii').ljust(255, b'\0')
+    return (client_id + file_name_bytes + struct.pack('<IIHH', file_size, offset, packet_number, total_packets)
+            + transfer_nonce)
+
+
+def create_download_chunk_header(payload_size):
+    """
+    Creates the header of a download chunk response (code 1610), which carries a
+    chunk of a stored file sealed with AES-GCM after its download_chunk_prefix.
+    """
+    return create_response_header(1610, payload_size, SEALED_VERSION)
+
+
 def create_reconnect_confirm(client_id, encrypted_aes_key):
     """
     Creates a response confirming successful client reconnection. This includes
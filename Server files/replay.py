@@ -0,0 +1,331 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from capture import read_trace, decode_client, OPEN, REQUEST, CLOSE, CLIENT
+from dataBase import DATABASE_NAME, configure_database, setup_database, add_client, update_client_key
+from loadgen import RESPONSE_HEADER, Stats, percentile, start_local_server, free_port, read_rss
+from protocol import REQUEST_HEADER, REQUEST_HEADER_SIZE, WINDOWED_VERSION, decode_name
+
+RESPONSE_TIMEOUT = 30.0  # Seconds a connection waits for outstanding responses after its last request
+ERROR_RESPONSES = {1601, 1606, 1607}  # Registration failed, reconnect denied, general error
+
+
+class TracedConnection:
+    """
+    The requests of one captured connection with their times, in seconds since the
+    start of the capture.
+    """
+
+    def __init__(self, name, opened):
+        self.name = name
+        self.opened = opened
+        self.requests = []  # (seconds, request bytes)
+
+
+def load_traces(paths):
+    """
+    Reads trace files, one per server process, and returns their connections ordered
+    by the time they were opened, and the latest captured row of every client.
+    """
+    connections = {}
+    clients = {}
+    for index, path in enumerate(paths):
+        for kind, number, seconds, body in read_trace(path):
+            key = (index, number)
+            if kind == OPEN:
+                connections[key] = TracedConnection(f"{os.path.basename(path)}:{number}", seconds)
+            elif kind == REQUEST and key in connections:
+                connections[key].requests.append((seconds, body))
+            elif kind == CLIENT:
+                client = decode_client(body)
+                clients[client[0]] = client
+            elif kind != CLOSE:
+                raise ValueError(f"Unknown record kind {kind} in {path}")
+    return sorted(connections.values(), key=lambda connection: connection.opened), list(clients.values())
+
+
+def seed_clients(workdir, clients):
+    """
+    Creates the database of the local server in workdir with the captured clients,
+    so replayed requests find the same client IDs and keys.
+    """
+    configure_database(os.path.join(workdir, DATABASE_NAME))
+    try:
+        setup_database()
+        for client_id, name, public_key, aes_key in clients:
+            add_client(client_id, name, aes_key)
+            if public_key is not None:
+                update_client_key(client_id, public_key)
+    finally:
+        configure_database()
+
+
+class Outstanding:
+    """
+    A request sent during the replay that is waiting for its response.
+    """
+    __slots__ = ('code', 'sent', 'file_name', 'packet_number', 'windowed')
+
+    def __init__(self, request, sent):
+        _, version, self.code, _ = REQUEST_HEADER.unpack_from(request)
+        self.sent = sent
+        self.windowed = self.code == 828 and version >= WINDOWED_VERSION
+        payload = request[REQUEST_HEADER_SIZE:]
+        if self.code == 828:
+            self.packet_number, = struct.unpack_from('<H', payload, 8)
+            self.file_name = decode_name(payload[12:267])
+        else:
+            self.packet_number, self.file_name = None, None
+
+
+class ConnectionReplay:
+    """
+    Replays one captured connection: its requests are sent on the original schedule
+    divided by the speed factor while a second thread reads the responses. Windowed
+    file chunks are answered by cumulative acks, so a 1608 completes every chunk it
+    covers and a 1603 every chunk of its file; other responses complete the oldest
+    request still waiting.
+    """
+
+    def __init__(self, traced, host, port, stats, start, speed):
+        self.traced = traced
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.start = start
+        self.speed = speed
+        self.sock = None
+        self._outstanding = deque()
+        self._lock = threading.Lock()
+        self._answered = threading.Condition(self._lock)
+
+    def _wait_until(self, seconds):
+        if self.speed:
+            delay = self.start + seconds / self.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def run(self):
+        self._wait_until(self.traced.opened)
+        try:
+            self.sock = socket.create_connection((self.host, self.port))
+        except OSError as e:
+            logging.error("Connection %s failed: %s", self.traced.name, e)
+            self.stats.add(errors=1)
+            return
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receiver = threading.Thread(target=self._receive, name=f"{threading.current_thread().name}-receiver")
+        receiver.start()
+        try:
+            for seconds, request in self.traced.requests:
+                self._wait_until(seconds)
+                with self._lock:
+                    self._outstanding.append(Outstanding(request, time.perf_counter()))
+                self.sock.sendall(request)
+                self.stats.add(bytes_sent=len(request))
+            with self._lock:
+                self._answered.wait_for(lambda: not self._outstanding, RESPONSE_TIMEOUT)
+        except OSError as e:
+            logging.error("Connection %s failed: %s", self.traced.name, e)
+            self.stats.add(errors=1)
+        finally:
+            self.sock.shutdown(socket.SHUT_RDWR)
+            receiver.join()
+            self.sock.close()
+            with self._lock:
+                self.stats.add(unanswered=len(self._outstanding))
+
+    def _recv_exactly(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return bytes(data)
+
+    def _receive(self):
+        try:
+            while True:
+                _, code, size = RESPONSE_HEADER.unpack(self._recv_exactly(RESPONSE_HEADER.size))
+                payload = self._recv_exactly(size)
+                self.stats.add(bytes_received=RESPONSE_HEADER.size + size)
+                self._complete(code, payload, time.perf_counter())
+        except (EOFError, OSError):
+            pass
+
+    def _complete(self, code, payload, now):
+        """
+        Records the latency of the requests a response answers.
+        """
+        with self._lock:
+            if code == 1608:
+                file_name = decode_name(payload[16:271])
+                acked, = struct.unpack_from('<H', payload, 271)
+                done = [entry for entry in self._outstanding
+                        if entry.windowed and entry.file_name == file_name and entry.packet_number <= acked]
+            elif code == 1603:
+                file_name = decode_name(payload[20:275])
+                done = [entry for entry in self._outstanding if entry.code == 828 and entry.file_name == file_name]
+            elif code == 1610:
+                packet_number, total_packets = struct.unpack_from('<HH', payload, 279)
+                done = [] if packet_number < total_packets else \
+                    [entry for entry in self._outstanding if entry.code == 830][:1]
+            else:
+                done = [entry for entry in self._outstanding if not entry.windowed][:1] or \
+                    list(self._outstanding)[:1]
+            for entry in done:
+                self._outstanding.remove(entry)
+                self.stats.record(entry.code, now - entry.sent)
+            if code in ERROR_RESPONSES and done:
+                self.stats.errors_by_code[done[0].code] = self.stats.errors_by_code.get(done[0].code, 0) + 1
+            self._answered.notify_all()
+
+
+def summarize(stats, elapsed):
+    """
+    Returns the results of a replay as a dictionary that can be saved as a baseline.
+    """
+    requests = {}
+    for code in sorted(stats.latencies):
+        values = sorted(stats.latencies[code])
+        requests[str(code)] = {'count': len(values), 'p50': percentile(values, 0.5),
+                               'p99': percentile(values, 0.99), 'max': values[-1]}
+    return {'elapsed': elapsed, 'requests': requests, 'errors': stats.errors, 'unanswered': stats.unanswered,
+            'error_responses': {str(code): count for code, count in sorted(stats.errors_by_code.items())},
+            'bytes_sent': stats.bytes_sent, 'bytes_received': stats.bytes_received}
+
+
+def report(summary, baseline=None, rss=None):
+    """
+    Prints latency percentiles per request code, next to the baseline's if given.
+    Returns the largest p99 increase over the baseline in percent, or None.
+    """
+    total = sum(entry['count'] for entry in summary['requests'].values())
+    print(f"{total} requests in {summary['elapsed']:.2f} s ({total / summary['elapsed']:.0f} requests/s), "
+          f"{summary['errors']} connection errors, {summary['unanswered']} unanswered")
+    if summary['error_responses']:
+        print("error responses by request code: "
+              + ", ".join(f"{code}: {count}" for code, count in summary['error_responses'].items()))
+    print(f"wire: {summary['bytes_sent'] / 1e6:.1f} MB sent, {summary['bytes_received'] / 1e6:.1f} MB received")
+    worst = None
+    if baseline is None:
+        print(f"{'code':>6} {'count':>8} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    else:
+        print(f"{'code':>6} {'count':>8} {'p50 ms':>9} {'base':>9} {'change':>8} {'p99 ms':>9} {'base':>9} "
+              f"{'change':>8}")
+    for code, entry in summary['requests'].items():
+        if baseline is None:
+            print(f"{code:>6} {entry['count']:>8} {entry['p50'] * 1e3:>9.3f} {entry['p99'] * 1e3:>9.3f} "
+                  f"{entry['max'] * 1e3:>9.3f}")
+            continue
+        base = baseline['requests'].get(code)
+        if base is None:
+            print(f"{code:>6} {entry['count']:>8} {entry['p50'] * 1e3:>9.3f} {'-':>9} {'':>8} "
+                  f"{entry['p99'] * 1e3:>9.3f} {'-':>9}")
+            continue
+        p50_change = (entry['p50'] / base['p50'] - 1) * 100 if base['p50'] else 0.0
+        p99_change = (entry['p99'] / base['p99'] - 1) * 100 if base['p99'] else 0.0
+        worst = p99_change if worst is None else max(worst, p99_change)
+        print(f"{code:>6} {entry['count']:>8} {entry['p50'] * 1e3:>9.3f} {base['p50'] * 1e3:>9.3f} "
+              f"{p50_change:>+7.1f}% {entry['p99'] * 1e3:>9.3f} {base['p99'] * 1e3:>9.3f} {p99_change:>+7.1f}%")
+    if rss is not None:
+        print(f"server RSS: {rss[0] / 1e6:.1f} MB, peak {rss[1] / 1e6:.1f} MB")
+    return worst
+
+
+def parse_args():
+    """
+    Parse the replay options.
+    """
+    parser = argparse.ArgumentParser(description="Replay captured client traffic against a server")
+    parser.add_argument('traces', nargs='+', help="trace files written with mainServer.py --capture")
+    parser.add_argument('--local', action='store_true',
+                        help="start a server in a temporary directory, seeded with the captured clients")
+    parser.add_argument('--engine', choices=['selectors', 'asyncio'], default='selectors',
+                        help="engine of the local server (default: selectors)")
+    parser.add_argument('--host', default='127.0.0.1', help="server address (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=1256, help="server port (default: 1256)")
+    parser.add_argument('--server-pid', type=int, default=None,
+                        help="process ID of a running server, to report its RSS")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="replay rate relative to the capture, e.g. 10 for ten times faster; "
+                             "0 sends every request as soon as possible (default: 1)")
+    parser.add_argument('--save', metavar='PATH', help="save the results as JSON, to serve as a baseline")
+    parser.add_argument('--baseline', metavar='PATH', help="compare the results with a saved run")
+    parser.add_argument('--max-regression', type=float, default=None, metavar='PERCENT',
+                        help="exit with status 1 if the p99 latency of any request code grew by more "
+                             "than PERCENT over the baseline")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must not be negative")
+    if args.max_regression is not None and args.baseline is None:
+        parser.error("--max-regression needs --baseline")
+    return args
+
+
+def main():
+    """
+    Replay the traces against a server and report the results.
+    """
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    connections, clients = load_traces(args.traces)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    server = None
+    workdir = None
+    server_pid = args.server_pid
+    if args.local:
+        workdir = tempfile.TemporaryDirectory(prefix='replay-')
+        seed_clients(workdir.name, clients)
+        args.host, args.port = '127.0.0.1', free_port()
+        server = start_local_server(workdir.name, args.port, args.engine)
+        server_pid = server.pid
+
+    stats = Stats()
+    stats.unanswered = 0
+    stats.errors_by_code = {}
+    start = time.perf_counter()
+    threads = []
+    try:
+        for index, traced in enumerate(connections):
+            replay = ConnectionReplay(traced, args.host, args.port, stats, start, args.speed)
+            if args.speed:
+                # Connections are started when they were opened, so idle ones cost no thread
+                delay = start + traced.opened / args.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            thread = threading.Thread(target=replay.run, name=f"replay-{index}")
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        summary = summarize(stats, elapsed)
+        worst = report(summary, baseline, read_rss(server_pid) if server_pid else None)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        if workdir is not None:
+            workdir.cleanup()
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if args.max_regression is not None and worst is not None and worst > args.max_regression:
+        print(f"p99 latency regressed by {worst:.1f}%, more than the allowed {args.max_regression:.1f}%")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
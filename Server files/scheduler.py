@@ -0,0 +1,162 @@
+import json
+import logging
+import threading
+import time
+
+QUOTAS_FILE = 'quotas.json'
+# Request bytes a connection may process per turn of the event loop before the
+# other ready connections get their turn
+TURN_QUANTUM = 64 * 1024
+# Limits used when the quotas file does not set them; None means unlimited
+DEFAULT_LIMITS = {
+    'bandwidth': None,     # Bytes per second of requests a client may send
+    'burst': None,         # Bytes a client may send at once above its rate (default: one second worth)
+    'max_uploads': None,   # Uploads a client may have open at the same time
+    'max_buffered': None   # Received bytes buffered per connection before reading pauses
+}
+ANONYMOUS_CLIENT = bytes(16)  # Client ID of requests sent before registration
+
+
+class UploadLimitReached(Exception):
+    """
+    Raised when a client starts an upload while it has max_uploads uploads open.
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket of one client. Requests are charged after they were read, so the
+    balance may go negative; the client is then paused until it is paid back.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def charge(self, size):
+        """
+        Takes size tokens and returns how many seconds the client has to wait before
+        it may send again, 0 if it may continue right away.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class ClientQuota:
+    """
+    The limits of one client with its bucket and open upload count.
+    """
+
+    def __init__(self, limits):
+        self.max_uploads = limits['max_uploads']
+        self.bucket = TokenBucket(limits['bandwidth'], limits['burst']) if limits['bandwidth'] else None
+        self.uploads = 0
+
+
+_default_limits = dict(DEFAULT_LIMITS)
+_client_limits = {}  # Client ID -> limits overriding the defaults
+_quotas = {}
+_lock = threading.Lock()
+
+
+def load_quotas(path=QUOTAS_FILE):
+    """
+    Reads the client limits from a JSON file of the form
+    {"default": {limits}, "clients": {"<client id in hex>": {limits}}}, where limits
+    holds any of the keys of DEFAULT_LIMITS. Without the file nothing is limited.
+    """
+    global _default_limits, _client_limits
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        config = {}
+    default_limits = dict(DEFAULT_LIMITS)
+    default_limits.update(_checked_limits(config.get('default', {})))
+    client_limits = {}
+    for client_id, limits in config.get('clients', {}).items():
+        client_limits[bytes.fromhex(client_id)] = dict(default_limits, **_checked_limits(limits))
+    with _lock:
+        _default_limits, _client_limits = default_limits, client_limits
+        _quotas.clear()
+    if config:
+        logging.info("Loaded quotas for %d clients from %s", len(client_limits), path)
+
+
+def _checked_limits(limits):
+    """
+    Validates the limits read for one client.
+    """
+    unknown = set(limits) - set(DEFAULT_LIMITS)
+    if unknown:
+        raise ValueError(f"Unknown quota settings: {', '.join(sorted(unknown))}")
+    for name, value in limits.items():
+        if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError(f"Quota {name} must be a positive number or null, got {value!r}")
+    return limits
+
+
+def get_limits(client_id):
+    """
+    Returns the limits of a client as a dictionary with the keys of DEFAULT_LIMITS.
+    """
+    return _client_limits.get(client_id, _default_limits)
+
+
+def get_quota(client_id):
+    """
+    Returns the quota of a client, creating it on first use.
+    """
+    quota = _quotas.get(client_id)
+    if quota is None:
+        with _lock:
+            quota = _quotas.get(client_id)
+            if quota is None:
+                quota = _quotas[client_id] = ClientQuota(get_limits(client_id))
+    return quota
+
+
+def default_max_buffered():
+    """
+    Returns the receive buffer limit of connections whose client is not known yet.
+    """
+    return _default_limits['max_buffered']
+
+
+def charge(client_id, size):
+    """
+    Charges size request bytes to a client's bandwidth and returns how many seconds
+    its connections have to pause. Requests sent before registration are not charged.
+    """
+    if client_id == ANONYMOUS_CLIENT or not get_limits(client_id)['bandwidth']:
+        return 0.0
+    bucket = get_quota(client_id).bucket
+    return bucket.charge(size) if bucket is not None else 0.0
+
+
+def start_upload(client_id):
+    """
+    Counts a new open upload of a client. Raises UploadLimitReached if the client
+    already has max_uploads uploads open.
+    """
+    quota = get_quota(client_id)
+    with _lock:
+        if quota.max_uploads is not None and quota.uploads >= quota.max_uploads:
+            raise UploadLimitReached(f"Client {client_id.hex()} already has {quota.uploads} uploads open")
+        quota.uploads += 1
+
+
+def end_upload(client_id):
+    """
+    Counts an upload of a client as closed.
+    """
+    quota = get_quota(client_id)
+    with _lock:
+        quota.uploads = max(0, quota.uploads - 1)
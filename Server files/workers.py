@@ -0,0 +1,162 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import time
+
+HAS_REUSEPORT = hasattr(socket, 'SO_REUSEPORT')
+RESTART_DELAY = 1.0  # Seconds to wait before restarting a worker that crashed
+MAX_RESTART_DELAY = 30.0  # Upper bound for the delay of a worker that keeps crashing
+STABLE_RUNTIME = 60.0  # A worker that ran this long resets its restart delay
+STOP_SIGNALS = (signal.SIGTERM, signal.SIGINT)  # Signals that make the supervisor stop its workers
+
+
+def create_listener(host, port, reuse_port=False):
+    """
+    Create a non-blocking listening socket. With reuse_port set, SO_REUSEPORT lets
+    several worker processes bind the same address and the kernel spreads incoming
+    connections across them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
+
+
+def _worker_entry(worker_main, host, port, shared_listener, slot):
+    """
+    Entry point of a worker process. Each worker binds its own SO_REUSEPORT socket,
+    or uses the listening socket inherited from the supervisor where SO_REUSEPORT
+    is not available.
+    """
+    # The supervisor's signal handling is not inherited, terminate() stops a worker
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    listener = shared_listener or create_listener(host, port, reuse_port=True)
+    worker_main(listener, slot)
+
+
+class Supervisor:
+    """
+    Runs the server in several worker processes so it can use more than one core.
+    Workers are forked, share the listening port and are restarted when they crash,
+    with an increasing delay if they keep crashing. SIGTERM and SIGINT stop the
+    supervisor together with its workers.
+    """
+
+    def __init__(self, host, port, worker_count, worker_main):
+        self.host = host
+        self.port = port
+        self.worker_count = worker_count
+        self.worker_main = worker_main
+        self._context = multiprocessing.get_context('fork')
+        self._shared_listener = None
+        self._workers = {}  # Process sentinel -> (process, slot, start time)
+        self._delays = {}   # Worker slot -> current restart delay
+        self._restarts = {}  # Worker slot -> when the crashed worker is started again
+        self._stopping = False
+
+    def _start_worker(self, slot):
+        """
+        Fork the worker for the given slot.
+        """
+        process = self._context.Process(target=_worker_entry, name=f"server-worker-{slot}",
+                                        args=(self.worker_main, self.host, self.port, self._shared_listener, slot))
+        process.start()
+        self._workers[process.sentinel] = (process, slot, time.monotonic())
+        logging.info("Started worker %d (pid %d)", slot, process.pid)
+
+    def _request_stop(self, signum, frame):
+        self._stopping = True
+
+    def run(self):
+        """
+        Start the workers and restart any that exit until a stop signal arrives.
+        Restarts are scheduled rather than waited for, so other workers that exit
+        and stop signals are handled while a restart is pending.
+        """
+        if not HAS_REUSEPORT:
+            # Workers inherit one accept socket instead of binding their own
+            self._shared_listener = create_listener(self.host, self.port)
+        # A signal writes to the wakeup socket, which ends the wait below
+        wakeup, wakeup_signal = socket.socketpair()
+        wakeup.setblocking(False)
+        wakeup_signal.setblocking(False)
+        handlers = {signum: signal.signal(signum, self._request_stop) for signum in STOP_SIGNALS}
+        wakeup_fd = signal.set_wakeup_fd(wakeup_signal.fileno())
+        try:
+            for slot in range(self.worker_count):
+                self._start_worker(slot)
+            logging.info("Server listening on %s:%d with %d workers", self.host, self.port, self.worker_count)
+            while not self._stopping:
+                timeout = None
+                if self._restarts:
+                    timeout = max(0.0, min(self._restarts.values()) - time.monotonic())
+                ready = multiprocessing.connection.wait(list(self._workers) + [wakeup], timeout)
+                for sentinel in ready:
+                    if sentinel is wakeup:
+                        try:
+                            wakeup.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        continue
+                    self._worker_exited(sentinel)
+                now = time.monotonic()
+                for slot, deadline in list(self._restarts.items()):
+                    if deadline <= now and not self._stopping:
+                        del self._restarts[slot]
+                        self._start_worker(slot)
+            logging.info("Stopping %d workers", len(self._workers))
+        finally:
+            signal.set_wakeup_fd(wakeup_fd)
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            wakeup.close()
+            wakeup_signal.close()
+            self.stop()
+
+    def _worker_exited(self, sentinel):
+        """
+        Reap a worker that exited and schedule its restart.
+        """
+        process, slot, started = self._workers.pop(sentinel)
+        process.join()
+        delay = self._delays.get(slot, RESTART_DELAY)
+        if time.monotonic() - started >= STABLE_RUNTIME:
+            delay = RESTART_DELAY
+        logging.error("Worker %d (pid %d) exited with code %s, restarting in %.0fs", slot, process.pid,
+                      process.exitcode, delay)
+        self._delays[slot] = min(delay * 2, MAX_RESTART_DELAY)
+        self._restarts[slot] = time.monotonic() + delay
+
+    def stop(self):
+        """
+        Terminate all workers and wait for them to exit.
+        """
+        for process, _, _ in self._workers.values():
+            process.terminate()
+        for process, _, _ in self._workers.values():
+            process.join()
+        self._workers.clear()
+        self._restarts.clear()
+        if self._shared_listener is not None:
+            self._shared_listener.close()
+
+
+def run_workers(host, port, worker_count, worker_main):
+    """
+    Run worker_main(listener, slot) in worker_count supervised processes, where slot
+    numbers the workers from 0. Falls back to a single process where fork is not
+    available.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning("Worker processes need fork support. Running a single server process.")
+        worker_main(create_listener(host, port), 0)
+        return
+    Supervisor(host, port, worker_count, worker_main).run()